@@ -19,10 +19,64 @@
 # Contact: http://fxk.de.vu/
 
 import os
+import errno
 import string
 import re
+import time
+import tempfile
+import hashlib
+import bisect
 import locale
+import threading
+import Queue
+import cStringIO
+import subprocess
 import xml.parsers.expat
+from xml.sax.saxutils import escape
+
+# Use the persistent cache of driver option information. Can be disabled
+# by setting DRICONF_NO_CACHE in the environment.
+useSchemaCache = not os.environ.has_key("DRICONF_NO_CACHE")
+
+# Remember the fingerprint of normalized user configuration files, so
+# that NormalizeConfig can recognize an unchanged configuration quickly.
+# Disabled by DRICONF_NO_CACHE as well.
+useNormalCache = not os.environ.has_key("DRICONF_NO_CACHE")
+
+# Upper bound for the number of concurrently running probes.
+maxProbeWorkers = 8
+
+# Maximum number of validation results remembered per option by
+# OptInfo.validateCached.
+validCacheSize = 64
+
+# Number of xdriinfo and glxinfo runs so far. Replayed runs are counted
+# as well.
+spawnCount = 0
+_spawnLock = threading.Lock()
+
+# Seconds after which a probe process is killed. None disables the
+# timeout.
+probeTimeout = 30
+
+# (argv, wall time, exit status) of every probe process run so far. The
+# status is None if the process was stopped early.
+probeLog = []
+
+# Probe processes that are currently running.
+_runningProbes = {}
+
+# Bump this when the format of the cache files changes.
+schemaCacheVersion = 1
+
+# Bump this when the normalization or the fingerprints change.
+normalCacheVersion = 1
+
+# Directories searched for DRI driver modules after LIBGL_DRIVERS_PATH.
+driverSearchPath = ["/usr/lib/dri", "/usr/lib64/dri", "/usr/lib32/dri",
+                    "/usr/lib/x86_64-linux-gnu/dri",
+                    "/usr/lib/i386-linux-gnu/dri", "/usr/local/lib/dri",
+                    "/usr/lib/xorg/modules/dri", "/usr/X11R6/lib/modules/dri"]
 
 
 class Error(Exception):
@@ -45,25 +99,483 @@ class XMLError(Error):
     pass
 
 
-def XDriInfo(argStr, dpy=None):
+class ReplayError(DRIError):
+    """ Probe output missing from a recording
+
+    Unlike other DRIErrors it never means that a screen or driver is
+    not direct rendering capable, so it is not silently ignored. """
+    pass
+
+
+class ProbeInterrupted(DRIError):
+    """ A probe process timed out or was cancelled
+
+    Running the probe differently won't help, so there is no fallback
+    for it. """
+    pass
+
+
+def _CountSpawn():
+    """ Helper: count a spawned probe process. """
+    global spawnCount
+    _spawnLock.acquire()
+    try:
+        spawnCount = spawnCount + 1
+    finally:
+        _spawnLock.release()
+
+
+def _KillProbe(child, reason):
+    """ Helper: kill a running probe process and remember why. """
+    _spawnLock.acquire()
+    try:
+        if not _runningProbes.has_key(child):
+            return
+        _runningProbes[child] = reason
+    finally:
+        _spawnLock.release()
+    try:
+        child.kill()
+    except OSError:
+        pass
+
+
+def CancelProbes():
+    """ Kill all running probe processes.
+
+    The functions waiting for them raise a ProbeInterrupted error. """
+    _spawnLock.acquire()
+    try:
+        children = _runningProbes.keys()
+    finally:
+        _spawnLock.release()
+    for child in children:
+        _KillProbe(child, "cancelled")
+
+
+def _LogProbe(argv, wallTime, status):
+    """ Helper: record a probe run in probeLog. """
+    _spawnLock.acquire()
+    try:
+        probeLog.append((tuple(argv), wallTime, status))
+    finally:
+        _spawnLock.release()
+
+
+def _SpawnProbe(argv, timeout, lineFilter):
+    """ Helper: run a probe program in a child process.
+
+    See RunProbe. """
+    name = argv[0]
+    errFile = tempfile.TemporaryFile()
+    _CountSpawn()
+    start = time.time()
+    try:
+        child = subprocess.Popen(argv, bufsize=-1, stdout=subprocess.PIPE,
+                                 stderr=errFile)
+    except OSError, problem:
+        errFile.close()
+        if problem.errno == errno.ENOENT:
+            raise DRIError(name + " not found.")
+        raise DRIError(name + " could not be started: " + str(problem))
+    _spawnLock.acquire()
+    try:
+        _runningProbes[child] = None
+    finally:
+        _spawnLock.release()
+    timer = None
+    if timeout != None:
+        timer = threading.Timer(timeout, _KillProbe, (child, "timed out"))
+        # Timers started from daemon worker threads would inherit their
+        # daemon flag and die noisily at interpreter shutdown.
+        timer.setDaemon(False)
+        timer.start()
+    stopped = False
+    try:
+        if lineFilter == None:
+            output = child.stdout.read()
+        else:
+            lines = []
+            for line in iter(child.stdout.readline, ""):
+                lines.append(line)
+                if lineFilter(line):
+                    stopped = True
+                    break
+            output = "".join(lines)
+            # Don't wait for the rest of the output.
+            if stopped and child.poll() == None:
+                try:
+                    child.terminate()
+                except OSError:
+                    pass
+        child.stdout.close()
+        status = child.wait()
+    finally:
+        if timer != None:
+            timer.cancel()
+        _spawnLock.acquire()
+        try:
+            reason = _runningProbes.pop(child, None)
+        finally:
+            _spawnLock.release()
+    wallTime = time.time() - start
+    if stopped and reason == None:
+        status = None
+    _LogProbe(argv, wallTime, status)
+    errFile.seek(0)
+    errors = string.strip(errFile.read())
+    errFile.close()
+    errorClass = DRIError
+    if reason != None:
+        errorClass = ProbeInterrupted
+    if reason == "timed out":
+        problem = "%s timed out after %g seconds." % (name, timeout)
+    elif reason != None:
+        problem = name + " " + reason + "."
+    elif status == None or status == 0:
+        return output
+    elif status < 0:
+        problem = "%s killed by signal %d." % (name, -status)
+    else:
+        problem = name + " returned with non-zero exit code."
+    if errors:
+        problem = problem + "\n" + errors
+    raise errorClass(problem)
+
+
+def _ProbeKey(argv):
+    """ Helper: file name for the recorded output of a probe run.
+
+    The display is left out, only a screen number in it is kept, for
+    example "xdriinfo-options-i965" or "glxinfo-B.1". """
+    words = [argv[0]]
+    screen = ""
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-display" and i + 1 < len(argv):
+            match = re.search("\\.(\\d+)$", argv[i+1])
+            if match:
+                screen = "." + match.group(1)
+            i = i + 2
+            continue
+        words.append(argv[i].lstrip("-"))
+        i = i + 1
+    return string.join(words, "-").replace(os.sep, "_") + screen
+
+
+class SubprocessBackend(object):
+    """ Runs the real probe programs.
+
+    usesSchemaCache tells DriverInfo whether it may read driver option
+    information from the schema cache instead of running xdriinfo. """
+
+    usesSchemaCache = True
+
+    def run(self, argv, timeout, lineFilter):
+        return _SpawnProbe(argv, timeout, lineFilter)
+
+
+class ReplayBackend(object):
+    """ Serves probe output recorded by a RecordBackend.
+
+    The output of each run is read from a file named by _ProbeKey in
+    directory. If a file with the suffix ".err" exists instead, a
+    DRIError with its contents is raised. If neither exists, a
+    ReplayError is raised. No X server or DRI driver is needed. """
+
+    usesSchemaCache = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def run(self, argv, timeout, lineFilter):
+        start = time.time()
+        path = os.path.join(self.directory, _ProbeKey(argv))
+        _CountSpawn()
+        if os.path.exists(path + ".err"):
+            _LogProbe(argv, time.time() - start, 1)
+            raise DRIError(string.strip(open(path + ".err").read()))
+        try:
+            output = open(path).read()
+        except IOError:
+            _LogProbe(argv, time.time() - start, 1)
+            raise ReplayError(argv[0] + " output not recorded: " + path)
+        if lineFilter != None:
+            lines = []
+            for line in output.splitlines(True):
+                lines.append(line)
+                if lineFilter(line):
+                    break
+            output = string.join(lines, "")
+        _LogProbe(argv, time.time() - start, 0)
+        return output
+
+
+class RecordBackend(object):
+    """ Records probe output for a ReplayBackend.
+
+    The probes are run by backend (default a SubprocessBackend) and
+    their output or error message is saved in directory. The schema
+    cache is not used, so that the output of all probes is recorded. """
+
+    usesSchemaCache = False
+
+    def __init__(self, directory, backend=None):
+        if backend == None:
+            backend = SubprocessBackend()
+        self.directory = directory
+        self.backend = backend
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def run(self, argv, timeout, lineFilter):
+        path = os.path.join(self.directory, _ProbeKey(argv))
+        try:
+            output = self.backend.run(argv, timeout, lineFilter)
+        except DRIError, problem:
+            open(path + ".err", "w").write(str(problem) + "\n")
+            raise
+        if os.path.exists(path + ".err"):
+            os.remove(path + ".err")
+        open(path, "w").write(output)
+        return output
+
+
+def ProbeBackendFromSpec(spec):
+    """ Create a probe backend from a specification string.
+
+    spec is "replay:DIRECTORY", "record:DIRECTORY" or empty for the
+    real probe programs. This is how DRICONF_PROBE in the environment
+    is interpreted.
+
+    Raises a ValueError if spec is not understood. """
+    if not spec:
+        return SubprocessBackend()
+    kind, sep, directory = spec.partition(":")
+    if kind == "replay" and directory:
+        return ReplayBackend(directory)
+    elif kind == "record" and directory:
+        return RecordBackend(directory)
+    raise ValueError("invalid probe backend: " + spec)
+
+
+# The backend running all probes. Set DRICONF_PROBE in the environment
+# to replay or record probe output, see ProbeBackendFromSpec.
+probeBackend = ProbeBackendFromSpec(os.environ.get("DRICONF_PROBE"))
+
+
+def RunProbe(argv, timeout=None, lineFilter=None, counter=None):
+    """ Run a probe program and return its output.
+
+    argv is executed directly, without a shell. The process is killed
+    if it runs longer than timeout seconds (default probeTimeout). If
+    lineFilter is given, it is called with every line of output and
+    the process is stopped as soon as it returns true. In that case
+    the output read so far is returned.
+
+    The program is run by probeBackend. If counter is given, its
+    countSpawn method is called for the run, see DisplayInfo.
+
+    Raises a DRIError if the program can't be run or fails, and a
+    ProbeInterrupted error if it times out or is cancelled. The message
+    includes the program's error output. """
+    if timeout == None:
+        timeout = probeTimeout
+    if counter != None:
+        counter.countSpawn()
+    return probeBackend.run(argv, timeout, lineFilter)
+
+
+def XDriInfo(argStr, dpy=None, timeout=None, counter=None):
     """ Call xdriinfo and raise DRIError on different failure conditions """
+    argv = ["xdriinfo"]
     if dpy != None:
-        dpyStr = "-display " + dpy + " "
+        argv.extend(["-display", dpy])
+    argv.extend(string.split(argStr))
+    return RunProbe(argv, timeout, counter=counter)
+
+
+def _ParallelMap(func, args, workers):
+    """ Helper: apply func to all args in a pool of worker threads.
+
+    Returns a list of (result, exception) tuples in the order of args.
+    Exceptions raised by func are caught and returned to the caller. """
+    results = [None for arg in args]
+    queue = Queue.Queue()
+    for i in range(len(args)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (func(args[i]), None)
+            except Exception, problem:
+                results[i] = (None, problem)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(args)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _CacheDir():
+    """ Helper: directory of all driconf cache files. """
+    if os.environ.has_key("XDG_CACHE_HOME") and os.environ["XDG_CACHE_HOME"]:
+        cacheHome = os.environ["XDG_CACHE_HOME"]
     else:
-        dpyStr = ""
-    infopipe = os.popen("xdriinfo " + dpyStr + argStr, "r")
-    driInfo = infopipe.read()
-    result = infopipe.close()
-    if result != None:
-        signal = result & 0xff
-        status = result >> 8
-        if signal != 0:
-            raise DRIError("XDriInfo killed by signal " + signal + ".")
-        elif status == 127:
-            raise DRIError("XDriInfo not found.")
+        cacheHome = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cacheHome, "driconf")
+
+
+def _SchemaCacheFile(name):
+    """ Helper: name of the schema cache file for the named driver. """
+    return os.path.join(_CacheDir(), name + ".xml")
+
+
+def _DriverFingerprint(name):
+    """ Helper: fingerprint of the installed module of the named driver.
+
+    The fingerprint identifies the driver module and the libGL next to
+    it by path, inode, size and modification time, so it changes when
+    Mesa is upgraded. Returns None if the driver module can't be found,
+    in that case the schema cache is not used. """
+    if not name or name[0] == "." or name.find("/") != -1:
+        return None
+    dirs = []
+    if os.environ.has_key("LIBGL_DRIVERS_PATH"):
+        dirs = string.split(os.environ["LIBGL_DRIVERS_PATH"], ":")
+    for dir in dirs + driverSearchPath:
+        path = os.path.realpath(os.path.join(dir, name + "_dri.so"))
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        result = "v%d %s %d %d %d" % (schemaCacheVersion, path, st.st_ino,
+                                      st.st_size, st.st_mtime)
+        libGL = os.path.join(os.path.dirname(os.path.dirname(path)),
+                             "libGL.so.1")
+        try:
+            st = os.stat(os.path.realpath(libGL))
+        except OSError:
+            pass
         else:
-            raise DRIError("XDriInfo returned with non-zero exit code.")
-    return driInfo
+            result = result + " %d %d" % (st.st_size, st.st_mtime)
+        return result
+    return None
+
+
+def _ReadSchemaCache(name, fingerprint):
+    """ Helper: read cached option XML of the named driver.
+
+    Returns None if there is no cache entry matching fingerprint. """
+    try:
+        cacheFile = open(_SchemaCacheFile(name), "r")
+        try:
+            if cacheFile.readline() != fingerprint + "\n":
+                return None
+            return cacheFile.read()
+        finally:
+            cacheFile.close()
+    except IOError:
+        return None
+
+
+def _WriteCacheFile(fileName, fingerprint, data):
+    """ Helper: atomically replace a cache file.
+
+    Failures are silently ignored, the cache is just an optimization. """
+    tmpName = "%s.%d" % (fileName, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(fileName)):
+            os.makedirs(os.path.dirname(fileName))
+        cacheFile = open(tmpName, "w")
+        try:
+            cacheFile.write(fingerprint + "\n")
+            cacheFile.write(data)
+        finally:
+            cacheFile.close()
+        os.rename(tmpName, fileName)
+    except (IOError, OSError):
+        try:
+            os.remove(tmpName)
+        except OSError:
+            pass
+
+
+def _WriteSchemaCache(name, fingerprint, driInfo):
+    """ Helper: store option XML of the named driver in the cache. """
+    _WriteCacheFile(_SchemaCacheFile(name), fingerprint, driInfo)
+
+
+def _NormalCacheFile(fileName):
+    """ Helper: name of the file remembering the fingerprint of the
+    normalized user configuration file fileName. """
+    return os.path.join(_CacheDir(), "normalized",
+                        hashlib.sha1(os.path.abspath(fileName)).hexdigest())
+
+
+def _ReadNormalCache(fileName):
+    """ Helper: fingerprint of the user configuration file fileName
+    when it was last normalized or None. """
+    try:
+        cacheFile = open(_NormalCacheFile(fileName), "r")
+        try:
+            return cacheFile.readline().rstrip("\n") or None
+        finally:
+            cacheFile.close()
+    except IOError:
+        return None
+
+
+def _WriteNormalCache(fileName, fingerprint):
+    """ Helper: remember the fingerprint of the normalized user
+    configuration file fileName. """
+    _WriteCacheFile(_NormalCacheFile(fileName), fingerprint,
+                    os.path.abspath(fileName) + "\n")
+
+
+def _QuoteAttr(value):
+    """ Helper: escape value for use in a double-quoted XML attribute. """
+    if "&" in value or "<" in value or ">" in value or '"' in value:
+        return escape(value, {'"': "&quot;"})
+    return value
+
+
+class _BufferedWriter(object):
+    """ Helper: collects output in chunks before writing it to a file.
+
+    Unicode strings are encoded as UTF-8. """
+
+    __slots__ = ("file", "chunks", "size")
+
+    # Write to the file when this many bytes are buffered.
+    bufferSize = 65536
+
+    def __init__(self, file):
+        self.file = file
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.chunks.append(data)
+        self.size = self.size + len(data)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.chunks))
+        self.chunks = []
+        self.size = 0
 
 
 def StrToValue(str, type):
@@ -112,9 +624,69 @@ def GetDesc(desc, preferredLangs):
     return None
 
 
-class Range:
+def _CompileValidator(type, valid):
+    """ Helper: compile a validation function for option values.
+
+    The function takes a string and returns True if it is a legal
+    value of the given type within the list of valid Ranges. The ranges
+    are sorted and merged so that a value can be found by bisection. """
+    if type == "bool":
+        return lambda str: str == "true" or str == "false"
+    elif type == "float":
+        convert = float
+    else:
+        convert = int
+    if not valid:
+
+        def validate(str):
+            try:
+                convert(str)
+            except ValueError:
+                return False
+            return True
+
+        return validate
+    ranges = [(r.start, r.end) for r in valid if r.start <= r.end]
+    ranges.sort()
+    starts = []
+    ends = []
+    for start, end in ranges:
+        if ends and start <= ends[-1]:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    if len(starts) == 1:
+        # Fast path for the common case of a single range
+        start = starts[0]
+        end = ends[0]
+
+        def validate(str):
+            try:
+                v = convert(str)
+            except ValueError:
+                return False
+            return start <= v <= end
+
+        return validate
+
+    def validate(str):
+        try:
+            v = convert(str)
+        except ValueError:
+            return False
+        i = bisect.bisect_right(starts, v) - 1
+        return i >= 0 and v <= ends[i]
+
+    return validate
+
+
+class Range(object):
     """ An interval """
 
+    __slots__ = ("start", "end")
+
     def __init__(self, str, type):
         """ Parse str as a range.
 
@@ -140,9 +712,11 @@ class Range:
         return self.start == self.end
 
 
-class OptDesc:
+class OptDesc(object):
     """ An option description in one language with enum values. """
 
+    __slots__ = ("lang", "text", "enums")
+
     def __init__(self, lang, text):
         self.lang = lang
         self.text = text
@@ -158,9 +732,12 @@ class OptDesc:
         return result
 
 
-class OptInfo:
+class OptInfo(object):
     """ All advertised information about an option. """
 
+    __slots__ = ("name", "type", "default", "valid", "validator", "validCache",
+                 "desc")
+
     def __init__(self, name, type, default, valid=None):
         """ Initialize option information.
 
@@ -182,6 +759,8 @@ class OptInfo:
                     "valid attribute is not allowed with bool options")
             else:
                 self.valid = [Range(x, type) for x in string.split(valid, ",")]
+        self.validator = _CompileValidator(type, self.valid)
+        self.validCache = {}
         if not self.validate(default):
             raise XMLError("default value is out of valid range")
         else:
@@ -200,28 +779,34 @@ class OptInfo:
 
     def validate(self, str):
         """ Check that str is of correct type and in a valid range. """
-        try:
-            v = StrToValue(str, self.type)
-        except XMLError:
-            return 0
-        if self.valid:
-            for r in self.valid:
-                if v >= r.start and v <= r.end:
-                    return 1
-            return 0
-        else:
-            return 1
+        return self.validator(str)
+
+    def validateCached(self, str):
+        """ Like validate, but results for recently validated strings are
+        remembered.
+
+        Use this where the same strings are validated again and again,
+        e.g. while the user edits a value. """
+        valid = self.validCache.get(str)
+        if valid == None:
+            valid = self.validator(str)
+            if len(self.validCache) >= validCacheSize:
+                self.validCache.clear()
+            self.validCache[str] = valid
+        return valid
 
     def getDesc(self, preferredLangs):
         return GetDesc(self.desc, preferredLangs)
 
 
-class OptSection:
+class OptSection(object):
     """ Representation of an option section.
 
     Contains descriptions and OptInfos as dictionaries. Options are also
     in a list so they can be extracted in a meaningful order. """
 
+    __slots__ = ("desc", "options", "optList")
+
     def __init__(self):
         """ Desc and options are initialized empty. """
         self.desc = {}
@@ -237,11 +822,11 @@ class OptSection:
 
     def validate(self, valDict):
         """ Validate a dictionary of option values agains this OptSection. """
-        allValid = 1
-        for name, opt in self.options.items():
-            if valDict.has_key(name):
-                allValid = allValid and opt.validate(valDict[name])
-        return allValid
+        for name, value in valDict.items():
+            if self.options.has_key(name) and \
+                   not self.options[name].validate(value):
+                return 0
+        return 1
 
     def getDesc(self, preferredLangs):
         return GetDesc(self.desc, preferredLangs)
@@ -269,6 +854,8 @@ class DriverInfo:
                                          attr["default"])
             self.curOptSection.options[attr["name"]] = self.curOption
             self.curOptSection.optList.append(self.curOption)
+            self.optIndex[attr["name"]] = self.curOption
+            self.optSectionIndex[attr["name"]] = self.curOptSection
         elif name == "description":
             if not attr.has_key("lang") or not attr.has_key("text"):
                 raise XMLError("description attribute missing")
@@ -301,16 +888,36 @@ class DriverInfo:
         elif name == "description":
             self.curOptDesc = None
 
-    def __init__(self, name):
+    def __init__(self, name, driInfo=None, counter=None):
         """ Obtain and parse config info for this driver.
 
+        If driInfo is given, it is parsed as the driver's config info.
+        Otherwise the config info is read from the schema cache if the
+        installed driver didn't change since it was cached, or obtained
+        from xdriinfo. The cache is not used when probe output is
+        recorded or replayed. counter is passed on to XDriInfo.
+
         Raises a DRIError if the driver does not support configuration.
 
         Raises a XMLError if the config info is illegal. """
         self.name = name
-        driInfo = XDriInfo("options " + name)
+        self.schemaFingerprint = None
+        fingerprint = None
+        if driInfo == None and useSchemaCache and \
+           probeBackend.usesSchemaCache:
+            fingerprint = _DriverFingerprint(name)
+            if fingerprint:
+                driInfo = _ReadSchemaCache(name, fingerprint)
+        if driInfo == None:
+            driInfo = XDriInfo("options " + name, counter=counter)
+        else:
+            # Given or already in the cache, don't write it to the cache.
+            fingerprint = None
 
         self.optSections = []
+        # Flat indexes of all options by name: OptInfo and OptSection
+        self.optIndex = {}
+        self.optSectionIndex = {}
         self.curOptSection = None
         self.curOption = None
         self.curOptDesc = None
@@ -324,6 +931,9 @@ class DriverInfo:
         except xml.parsers.expat.ExpatError, problem:
             raise XMLError("ExpatError: " + str(problem))
 
+        if fingerprint:
+            _WriteSchemaCache(name, fingerprint, driInfo)
+
     def __str__(self):
         result = '<driconf>\n'
         for sect in self.optSections:
@@ -333,19 +943,34 @@ class DriverInfo:
 
     def validate(self, valDict):
         """ Validate a dictionary of option values against this DriverInfo. """
-        allValid = 1
-        for optSection in self.optSections:
-            allValid = allValid and optSection.validate(valDict)
-        return allValid
+        for name, value in valDict.items():
+            if self.optIndex.has_key(name) and \
+                   not self.optIndex[name].validate(value):
+                return 0
+        return 1
+
+    def fingerprint(self):
+        """ Stable hash of the names, types, defaults and valid ranges of
+        all options. """
+        if self.schemaFingerprint == None:
+            schema = u"\n".join([unicode(str(opt), "utf-8")
+                                 for sect in self.optSections
+                                 for opt in sect.optList])
+            self.schemaFingerprint = \
+                hashlib.sha1(schema.encode("utf-8")).hexdigest()
+        return self.schemaFingerprint
 
     def getOptInfo(self, name):
         """ Return an option info for a given option name.
 
         If no such option exists in any section, None is returned. """
-        for optSection in self.optSections:
-            if optSection.options.has_key(name):
-                return optSection.options[name]
-        return None
+        return self.optIndex.get(name)
+
+    def getOptSection(self, name):
+        """ Return the option section containing the named option.
+
+        If no such option exists in any section, None is returned. """
+        return self.optSectionIndex.get(name)
 
 
 def _GLXInfoToUnicode(string):
@@ -372,8 +997,28 @@ def _GLXInfoToUnicode(string):
     return unicode(string, 'ascii', 'replace')
 
 
+def _ReadGLXInfo(argv, timeout=None, counter=None):
+    """ Helper: run glxinfo and find the vendor and renderer strings.
+
+    glxinfo is stopped as soon as both strings are found. Returns a
+    (vendor, renderer) tuple, missing strings are None.
+
+    Raises a DRIError if glxinfo can't be run or fails. """
+    found = {}
+
+    def lineFilter(line):
+        if line.startswith("OpenGL vendor string: "):
+            found["vendor"] = line[22:].rstrip("\n")
+        elif line.startswith("OpenGL renderer string: "):
+            found["renderer"] = line[24:].rstrip("\n")
+        return len(found) == 2
+
+    RunProbe(argv, timeout, lineFilter, counter)
+    return found.get("vendor"), found.get("renderer")
+
+
 class GLXInfo:
-    def __init__(self, screen, dpy):
+    def __init__(self, screen, dpy, timeout=None, counter=None):
         if dpy == None:
             if os.environ.has_key("DISPLAY"):
                 dpy = os.environ["DISPLAY"]
@@ -382,68 +1027,212 @@ class GLXInfo:
         dot = dpy.find(".")
         if dot != -1:
             dpy = dpy[:dot]
-        dpyStr = "-display " + dpy + "." + str(screen)
-        infopipe = os.popen("glxinfo " + dpyStr, "r")
-        glxInfo = infopipe.read()
-        result = infopipe.close()
-        if result != None:
-            signal = result & 0xff
-            status = result >> 8
-            if signal != 0:
-                raise DRIError("glxinfo killed by signal " + signal + ".")
-            elif status == 127:
-                raise DRIError("glxinfo not found.")
-            else:
-                raise DRIError("glxinfo returned with non-zero exit code.")
-        else:
-            # Parse
-            vMatch = re.search("^OpenGL vendor string: (.*)$", glxInfo, re.M)
-            rMatch = re.search("^OpenGL renderer string: (.*)$", glxInfo, re.M)
-            self.vendor = vMatch and vMatch.group(1)
-            self.renderer = rMatch and rMatch.group(1)
-            if not self.vendor or not self.renderer:
-                raise DRIError("unable to parse glxinfo output.")
-            # Make sure we end up with valid unicode
-            self.vendor = _GLXInfoToUnicode(self.vendor)
-            self.renderer = _GLXInfoToUnicode(self.renderer)
-
-
-class ScreenInfo:
-    """ References a DriverInfo object with the real config info. """
-
-    def __init__(self, screen, dpy=None):
+        dpy = dpy + "." + str(screen)
+        # Try brief output first. glxinfo versions that don't know -B
+        # print something else, then fall back to the full output.
+        try:
+            self.vendor, self.renderer = _ReadGLXInfo(
+                ["glxinfo", "-B", "-display", dpy], timeout, counter)
+        except (ReplayError, ProbeInterrupted):
+            raise
+        except DRIError:
+            self.vendor = None
+            self.renderer = None
+        if not self.vendor or not self.renderer:
+            self.vendor, self.renderer = _ReadGLXInfo(
+                ["glxinfo", "-display", dpy], timeout, counter)
+        if not self.vendor or not self.renderer:
+            raise DRIError("unable to parse glxinfo output.")
+        # Make sure we end up with valid unicode
+        self.vendor = _GLXInfoToUnicode(self.vendor)
+        self.renderer = _GLXInfoToUnicode(self.renderer)
+
+
+class ScreenInfo(object):
+    """ References a DriverInfo object with the real config info.
+
+    GLX vendor and renderer information is available in glxInfo. It is
+    obtained from glxinfo the first time it is used. """
+
+    def __init__(self, screen, dpy=None, driverName=None, counter=None):
         """ Find or create the driver for this screen.
 
+        If driverName is None it is queried from xdriinfo. counter is
+        passed on to all probes of this screen, see RunProbe.
+
         Raises a DRIError if the screen is not direct rendering capable or
         if the DRI driver does not support configuration.
 
         Raises a XMLError if the config info is illegal. """
         self.num = screen
-        driverName = XDriInfo("driver " + str(screen), dpy)
+        if driverName == None:
+            driverName = string.strip(XDriInfo("driver " + str(screen), dpy,
+                                               counter=counter))
+        self.dpy = dpy
+        self.counter = counter
+        self.glxProbed = False
+        self._glxInfo = None
         try:
-            self.driver = GetDriver(driverName, 0)
+            self.driver = GetDriver(driverName, 0, counter)
         except XMLError, problem:
             raise XMLError(str(problem) + " (driver " + driverName + ")")
-        else:
+
+    def getGLXInfo(self):
+        """ Get the GLXInfo of this screen, running glxinfo if needed.
+
+        Returns None if glxinfo failed. """
+        if not self.glxProbed:
             try:
-                self.glxInfo = GLXInfo(screen, dpy)
+                self._glxInfo = GLXInfo(self.num, self.dpy,
+                                        counter=self.counter)
+            except ReplayError:
+                raise
             except DRIError:
-                self.glxInfo = None
+                self._glxInfo = None
+            self.glxProbed = True
+        return self._glxInfo
+
+    glxInfo = property(getGLXInfo)
 
 
 class DisplayInfo:
     """ Maintains config info for all screens and drivers on a display """
     drivers = {}
 
-    def __init__(self, dpy=None):
+    def __init__(self, dpy=None, parallel=False, batch=False, workers=None):
         """ Find all direct rendering capable screens on dpy.
 
+        If parallel is True, all screens are probed concurrently by at
+        most workers (default maxProbeWorkers) threads. If
+        batch is True, the drivers of all screens are queried with a
+        single xdriinfo run. The number of processes spawned for this
+        display, including later glxinfo runs, is stored in
+        self.spawnCount. Processes spawned for other displays at the
+        same time are not included.
+
         Raises a DRIError if xdriinfo does not work for some reason. """
         self.dpy = dpy
-        nScreens = int(XDriInfo("nscreens", dpy))
-        self.screens = [None for i in range(nScreens)]
-        for i in range(nScreens):
-            self.getScreen(i)
+        self.spawnCount = 0
+        self.spawnLock = threading.Lock()
+        names = None
+        if batch:
+            names = self.queryDrivers()
+        if names != None:
+            self.screens = [None for name in names]
+        else:
+            nScreens = int(XDriInfo("nscreens", dpy, counter=self))
+            self.screens = [None for i in range(nScreens)]
+        if parallel:
+            self.probeScreens(names, workers)
+        elif names != None:
+            self.probeScreens(names, 1)
+        else:
+            for i in range(nScreens):
+                self.getScreen(i)
+
+    def countSpawn(self):
+        """ Count a probe process spawned for this display. """
+        self.spawnLock.acquire()
+        try:
+            self.spawnCount = self.spawnCount + 1
+        finally:
+            self.spawnLock.release()
+
+    def queryDrivers(self):
+        """ Query the drivers of all screens with one xdriinfo run.
+
+        Returns a list with one (driverName, problem) tuple per
+        screen. driverName is None and problem a DRIError if the screen
+        is not direct rendering capable. Returns None if the output of
+        xdriinfo could not be understood. """
+        names = []
+        for line in string.split(XDriInfo("", self.dpy, counter=self), "\n"):
+            match = re.match("^[sS]creen (\\d+): (.*)$", line)
+            if not match:
+                continue
+            if int(match.group(1)) != len(names):
+                return None
+            name = string.strip(match.group(2))
+            if not name or name.find(" ") != -1:
+                names.append((None, DRIError(
+                    "screen " + match.group(1) + " is " + name)))
+            else:
+                names.append((name, None))
+        if not names:
+            return None
+        return names
+
+    def probeScreens(self, names=None, workers=None):
+        """ Probe all screens concurrently.
+
+        The probes run in a pool of at most workers (default
+        maxProbeWorkers) threads. The option information of each
+        distinct driver is obtained only once, even if it drives
+        several screens. If names is given, it is the result of
+        queryDrivers and the drivers of the screens are not queried
+        again.
+
+        Raises a XMLError if a DRI driver's configuration information is
+        invalid. """
+        if workers == None:
+            workers = maxProbeWorkers
+        indices = range(len(self.screens))
+        if names == None:
+            names = _ParallelMap(
+                lambda i: string.strip(XDriInfo("driver " + str(i),
+                                                self.dpy, counter=self)),
+                indices, workers)
+        distinct = {}
+        for name, problem in names:
+            if problem == None:
+                distinct[name] = None
+        distinct = distinct.keys()
+        # GetDriver caches the driver objects in DisplayInfo.drivers
+        driverProblems = {}
+        for name, (driver, problem) in zip(distinct, _ParallelMap(
+                lambda name: GetDriver(name, 0, self), distinct, workers)):
+            if problem != None:
+                driverProblems[name] = problem
+
+        def probe(i):
+            name, problem = names[i]
+            if problem != None:
+                raise problem
+            if driverProblems.has_key(name):
+                problem = driverProblems[name]
+                if isinstance(problem, XMLError):
+                    raise XMLError(str(problem) + " (driver " + name + ")")
+                raise problem
+            return ScreenInfo(i, self.dpy, name, self)
+
+        for i, (screen, problem) in zip(indices,
+                                        _ParallelMap(probe, indices, workers)):
+            if isinstance(problem, XMLError):
+                raise XMLError(str(problem) + " (screen " + str(i) + ")")
+            elif isinstance(problem, ReplayError) or \
+                     problem != None and not isinstance(problem, DRIError):
+                raise problem
+            self.screens[i] = screen
+
+    def probeGLXInfo(self, workers=None):
+        """ Run glxinfo on all screens that weren't probed yet.
+
+        The screens are probed concurrently in a pool of at most workers
+        (default maxProbeWorkers) threads. Use this before accessing the
+        glxInfo of every screen. """
+        if workers == None:
+            workers = maxProbeWorkers
+        screens = [screen for screen in self.screens
+                   if screen != None and not screen.glxProbed]
+        for glxInfo, problem in _ParallelMap(
+                lambda screen: screen.getGLXInfo(), screens, workers):
+            if problem != None:
+                raise problem
+
+    def glxInfoAvoided(self):
+        """ Count the screens on which glxinfo was not run (yet). """
+        return len([screen for screen in self.screens
+                    if screen != None and not screen.glxProbed])
 
     def getScreen(self, i):
         """ Get the screen object for screen i.
@@ -458,7 +1247,9 @@ class DisplayInfo:
         if self.screens[i] != None:
             return self.screens[i]
         try:
-            screen = ScreenInfo(i, self.dpy)
+            screen = ScreenInfo(i, self.dpy, counter=self)
+        except ReplayError:
+            raise
         except DRIError:
             screen = None
         except XMLError, problem:
@@ -468,73 +1259,295 @@ class DisplayInfo:
         return screen
 
 
-def GetDriver(name, catch=1):
+# One lock per driver name, so that concurrent probes of the same driver
+# wait for each other instead of running xdriinfo twice.
+_driverLocks = {}
+_driverLocksLock = threading.Lock()
+
+
+def GetDriver(name, catch=1, counter=None):
     """ Get the driver object for the named driver.
 
+    If the driver information has to be obtained, counter is passed on
+    to XDriInfo.
+
     Returns None if the DRI driver does not support configuration.
 
     Raises a XMLError if the DRI driver's configuration information is
     invalid. """
-    if DisplayInfo.drivers.has_key(name):
-        return DisplayInfo.drivers[name]
+    driver = DisplayInfo.drivers.get(name)
+    if driver != None:
+        return driver
+    _driverLocksLock.acquire()
+    try:
+        lock = _driverLocks.setdefault(name, threading.Lock())
+    finally:
+        _driverLocksLock.release()
+    lock.acquire()
     try:
-        driver = DriverInfo(name)
-    except DRIError, problem:
-        if catch:
-            driver = None
+        if DisplayInfo.drivers.has_key(name):
+            return DisplayInfo.drivers[name]
+        try:
+            driver = DriverInfo(name, counter=counter)
+        except ReplayError:
+            raise
+        except DRIError, problem:
+            if catch:
+                driver = None
+            else:
+                raise DRIError(problem)
         else:
-            raise DRIError(problem)
-    else:
-        DisplayInfo.drivers[name] = driver
+            DisplayInfo.drivers[name] = driver
+    finally:
+        lock.release()
     return driver
 
 
-class AppConfig:
+def ProbeDisplays(dpyList, workers=None, parallel=True, batch=True):
+    """ Probe several displays concurrently.
+
+    At most workers (default maxProbeWorkers) probes run at the same
+    time. They are divided between the displays probed concurrently.
+    Driver information is shared between all displays. parallel and
+    batch are passed on to DisplayInfo.
+
+    Returns a list of (displayInfo, problem) tuples in the order of
+    dpyList. displayInfo is None and problem the exception if probing
+    a display failed. """
+    if workers == None:
+        workers = maxProbeWorkers
+    displayWorkers = max(1, min(workers, len(dpyList)))
+    screenWorkers = max(1, workers / displayWorkers)
+    return _ParallelMap(
+        lambda dpy: DisplayInfo(dpy, parallel, batch, screenWorkers),
+        dpyList, displayWorkers)
+
+
+class DisplayProbe(threading.Thread):
+    """ Probes a display in the background.
+
+    Use this to keep an event loop responsive while probing. callback,
+    if given, is called with (displayInfo, problem) from the probing
+    thread when it is done. Main loops that are not thread-safe should
+    forward the call to their own thread, e.g. with gobject.idle_add. """
+
+    def __init__(self, dpy=None, callback=None, parallel=True, batch=True):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.dpy = dpy
+        self.callback = callback
+        self.parallel = parallel
+        self.batch = batch
+        self.displayInfo = None
+        self.problem = None
+        self.start()
+
+    def run(self):
+        try:
+            self.displayInfo = DisplayInfo(self.dpy, self.parallel,
+                                           self.batch)
+        except Exception, problem:
+            self.problem = problem
+        if self.callback != None:
+            self.callback(self.displayInfo, self.problem)
+
+    def done(self):
+        """ Check if probing has finished. """
+        return not self.isAlive()
+
+    def result(self, timeout=None):
+        """ Wait for the probe and return the DisplayInfo.
+
+        Raises the exception probing failed with. Returns None if
+        probing did not finish within timeout seconds. """
+        self.join(timeout)
+        if self.isAlive():
+            return None
+        if self.problem != None:
+            raise self.problem
+        return self.displayInfo
+
+
+class AppConfig(object):
     """ Configuration data of an application given by the executable name.
 
-    If no executable name is specified it applies to all applications. """
+    If no executable name is specified it applies to all applications.
+
+    The user interfaces keep some state in modified (a callback for
+    registering modifications) and isValid.
+
+    line is the line number in the configuration file, if it was read
+    from one. optionLines maps option names to line numbers if the file
+    was parsed with trackLines.
+
+    Changing name or executable keeps the indexes of the device up to
+    date. """
+
+    __slots__ = ("device", "_name", "_executable", "options", "modified",
+                 "isValid", "line", "optionLines")
 
     def __init__(self, device, name, executable=None):
         self.device = device
-        self.name = name
-        self.executable = executable
+        self._name = name
+        self._executable = executable
         self.options = {}
+        self.modified = None
+        self.isValid = True
+        self.line = None
+        self.optionLines = None
+
+    def getName(self):
+        return self._name
+
+    def setName(self, name):
+        indexed = self.device != None and self.device.hasApp(self)
+        if indexed:
+            self.device.unindexApp(self)
+        self._name = name
+        if indexed:
+            self.device.indexApp(self)
+
+    name = property(getName, setName)
+
+    def getExecutable(self):
+        return self._executable
+
+    def setExecutable(self, executable):
+        indexed = self.device != None and self.device.hasApp(self)
+        if indexed:
+            self.device.unindexApp(self)
+        self._executable = executable
+        if indexed:
+            self.device.indexApp(self)
+
+    executable = property(getExecutable, setExecutable)
 
     def __str__(self):
-        result = '        <application name="' + self.name + '"'
+        out = cStringIO.StringIO()
+        writer = _BufferedWriter(out)
+        self.write(writer)
+        writer.flush()
+        return out.getvalue()[:-1]
+
+    def write(self, out):
+        """ Write the XML representation followed by a newline to out. """
         if self.executable != None:
-            result = result + ' executable="' + self.executable + '">\n'
+            out.write('        <application name="%s" executable="%s">\n' %
+                      (_QuoteAttr(self.name), _QuoteAttr(self.executable)))
         else:
-            result = result + '>\n'
+            out.write('        <application name="%s">\n' %
+                      _QuoteAttr(self.name))
         for n, v in self.options.items():
-            result = result + '            <option name="' + n + \
-                     '" value="' + v + '" />\n'
-        result = result + '        </application>'
-        return result
+            out.write('            <option name="%s" value="%s" />\n' %
+                      (_QuoteAttr(n), _QuoteAttr(v)))
+        out.write('        </application>\n')
 
 
-class DeviceConfig:
+class DeviceConfig(object):
     """ Configuration data of a device given by screen and/or driver.
 
-    If neither screen nor driver is specified it applies to all devices. """
+    If neither screen nor driver is specified it applies to all devices.
+
+    The user interfaces keep some state in modified (a callback for
+    registering modifications) and isNormalized.
+
+    line is the line number in the configuration file, if it was read
+    from one.
+
+    Applications are indexed by executable and by name. Use addApp and
+    removeApp instead of modifying the list apps directly to keep the
+    indexes up to date. """
+
+    __slots__ = ("config", "screen", "driver", "apps", "modified",
+                 "isNormalized", "line", "appsByExecutable", "appsByName")
 
     def __init__(self, config, screen=None, driver=None):
         self.config = config
         self.screen = screen
         self.driver = driver
         self.apps = []
+        self.modified = None
+        self.isNormalized = False
+        self.line = None
+        # executable or name -> list of AppConfigs
+        self.appsByExecutable = {}
+        self.appsByName = {}
+
+    def indexApp(self, app):
+        """ Helper: add app to the indexes. """
+        self.appsByExecutable.setdefault(app.executable, []).append(app)
+        self.appsByName.setdefault(app.name, []).append(app)
+
+    def unindexApp(self, app):
+        """ Helper: remove app from the indexes. """
+        for index, key in ((self.appsByExecutable, app.executable),
+                           (self.appsByName, app.name)):
+            apps = index[key]
+            apps.remove(app)
+            if not apps:
+                del index[key]
+
+    def hasApp(self, app):
+        """ Check if app belongs to this device. """
+        for indexed in self.appsByExecutable.get(app.executable, ()):
+            if indexed is app:
+                return True
+        return False
+
+    def addApp(self, app, sibling=None):
+        """ Add an application before sibling or at the end. """
+        if sibling != None:
+            self.apps.insert(self.apps.index(sibling), app)
+        else:
+            self.apps.append(app)
+        self.indexApp(app)
+
+    def removeApp(self, app):
+        """ Remove an application. """
+        self.apps.remove(app)
+        self.unindexApp(app)
+
+    def firstApp(self, apps):
+        """ Helper: the first of apps in the order of the list apps. """
+        if len(apps) == 1:
+            return apps[0]
+        return min([(self.apps.index(app), app) for app in apps])[1]
+
+    def getApp(self, executable):
+        """ Get the first application with the given executable.
+
+        executable None stands for applications without an executable.
+        Returns None if there is no such application. """
+        apps = self.appsByExecutable.get(executable)
+        if not apps:
+            return None
+        return self.firstApp(apps)
+
+    def getAppByName(self, name):
+        """ Get the first application with the given name or None. """
+        apps = self.appsByName.get(name)
+        if not apps:
+            return None
+        return self.firstApp(apps)
 
     def __str__(self):
-        result = '    <device'
+        out = cStringIO.StringIO()
+        writer = _BufferedWriter(out)
+        self.write(writer)
+        writer.flush()
+        return out.getvalue()[:-1]
+
+    def write(self, out):
+        """ Write the XML representation followed by a newline to out. """
+        out.write('    <device')
         if self.screen:
-            result = result + ' screen="' + self.screen + '"'
+            out.write(' screen="%s"' % _QuoteAttr(self.screen))
         if self.driver:
-            result = result + ' driver="' + self.driver + '"'
-        result = result + '>\n'
+            out.write(' driver="%s"' % _QuoteAttr(self.driver))
+        out.write('>\n')
         for a in self.apps:
-            result = result + str(a) + '\n'
-        result = result + '    </device>'
-        return result
+            a.write(out)
+        out.write('    </device>\n')
 
     def getDriver(self, display):
         """ Get the driver object for this device.
@@ -555,39 +1568,71 @@ class DeviceConfig:
         return driver
 
 
+def _NewDeviceConfig(config, attr):
+    """ Helper: create a DeviceConfig from device element attributes. """
+    if attr.has_key("screen") and attr.has_key("driver"):
+        return DeviceConfig(config, attr["screen"], attr["driver"])
+    elif attr.has_key("screen"):
+        return DeviceConfig(config, screen=attr["screen"])
+    elif attr.has_key("driver"):
+        return DeviceConfig(config, driver=attr["driver"])
+    else:
+        return DeviceConfig(config)
+
+
+def _NewAppConfig(device, attr):
+    """ Helper: create an AppConfig from application element attributes.
+
+    Raises XMLError if the device is None or attributes are missing. """
+    if device == None:
+        raise XMLError("application outside a device")
+    if not attr.has_key("name"):
+        raise XMLError("mandatory application attribute missing")
+    if attr.has_key("executable"):
+        return AppConfig(device, attr["name"], attr["executable"])
+    else:
+        return AppConfig(device, attr["name"])
+
+
+def _SetOption(app, attr, strings=None):
+    """ Helper: set an option from option element attributes in app.
+
+    If strings is a dictionary, it is used to share the strings of
+    option names and values that occur in many applications.
+
+    Raises XMLError if the app is None or attributes are missing. """
+    if app == None:
+        raise XMLError("option outside an application")
+    if not attr.has_key("name") or not attr.has_key("value"):
+        raise XMLError("option attribute missing")
+    name = attr["name"]
+    value = attr["value"]
+    if strings != None:
+        name = strings.setdefault(name, name)
+        value = strings.setdefault(value, value)
+    app.options[name] = value
+
+
 class DRIConfig:
     """ Configuration object representing one configuration file. """
 
     def startElement(self, name, attr):
         """ Handle start_element events from XML parser. """
         if name == "device":
-            if attr.has_key("screen") and attr.has_key("driver"):
-                self.curDevice = DeviceConfig(self, attr["screen"],
-                                              attr["driver"])
-            elif attr.has_key("screen"):
-                self.curDevice = DeviceConfig(self, screen=attr["screen"])
-            elif attr.has_key("driver"):
-                self.curDevice = DeviceConfig(self, driver=attr["driver"])
-            else:
-                self.curDevice = DeviceConfig(self)
+            self.curDevice = _NewDeviceConfig(self, attr)
+            self.curDevice.line = self.parser.CurrentLineNumber
             self.devices.append(self.curDevice)
         elif name == "application":
-            if self.curDevice == None:
-                raise XMLError("application outside a device")
-            if not attr.has_key("name"):
-                raise XMLError("mandatory application attribute missing")
-            if attr.has_key("executable"):
-                self.curApp = AppConfig(self.curDevice, attr["name"],
-                                        attr["executable"])
-            else:
-                self.curApp = AppConfig(self.curDevice, attr["name"])
-            self.curDevice.apps.append(self.curApp)
+            self.curApp = _NewAppConfig(self.curDevice, attr)
+            self.curApp.line = self.parser.CurrentLineNumber
+            self.curDevice.addApp(self.curApp)
         elif name == "option":
-            if self.curApp == None:
-                raise XMLError("option outside an application")
-            if not attr.has_key("name") or not attr.has_key("value"):
-                raise XMLError("option attribute missing")
-            self.curApp.options[attr["name"]] = attr["value"]
+            _SetOption(self.curApp, attr, self.strings)
+            if self.trackLines:
+                if self.curApp.optionLines == None:
+                    self.curApp.optionLines = {}
+                self.curApp.optionLines[attr["name"]] = \
+                    self.parser.CurrentLineNumber
 
     def endElement(self, name):
         """ Handle end_element events from XML parser. """
@@ -596,26 +1641,584 @@ class DRIConfig:
         elif name == "application":
             self.curApp = None
 
-    def __init__(self, file, fileName=""):
-        """ Parse configuration file. """
+    def __init__(self, file, fileName="", trackLines=False):
+        """ Parse configuration file.
+
+        The line numbers of device and application sections are always
+        recorded. If trackLines is True, the line numbers of option
+        settings are recorded, too.
+
+        digest is the SHA-1 hash of the file contents as they were read.
+        It is not updated when the configuration is modified. """
         self.devices = []
         self.curDevice = None
         self.curApp = None
+        self.digest = None
         if file:
             self.fileName = file.name
+            self.strings = {}
+            self.trackLines = trackLines
             p = xml.parsers.expat.ParserCreate()
             p.StartElementHandler = self.startElement
             p.EndElementHandler = self.endElement
+            self.parser = p
+            data = file.read()
+            self.digest = hashlib.sha1(data).hexdigest()
             try:
-                p.ParseFile(file)
+                p.Parse(data, True)
             except xml.parsers.expat.ExpatError, problem:
                 raise XMLError("ExpatError: " + str(problem))
+            del self.strings
+            del self.parser
         else:
             self.fileName = fileName
 
     def __str__(self):
-        result = '<driconf>\n'
+        out = cStringIO.StringIO()
+        self.write(out)
+        return out.getvalue()[:-1]
+
+    def write(self, file):
+        """ Write the configuration file to file.
+
+        The output is generated incrementally and written in chunks. """
+        out = _BufferedWriter(file)
+        out.write('<driconf>\n')
         for d in self.devices:
-            result = result + str(d) + '\n'
-        result = result + '</driconf>'
+            d.write(out)
+        out.write('</driconf>\n')
+        out.flush()
+
+
+class _ConfigRecordReader(object):
+    """ Helper: collects application records from XML parser events. """
+
+    def __init__(self):
+        self.records = []
+        self.curDevice = None
+        self.curApp = None
+
+    def startElement(self, name, attr):
+        """ Handle start_element events from XML parser. """
+        if name == "device":
+            self.curDevice = _NewDeviceConfig(None, attr)
+        elif name == "application":
+            self.curApp = _NewAppConfig(self.curDevice, attr)
+        elif name == "option":
+            _SetOption(self.curApp, attr)
+
+    def endElement(self, name):
+        """ Handle end_element events from XML parser. """
+        if name == "device":
+            self.curDevice = None
+        elif name == "application":
+            self.records.append((self.curDevice, self.curApp,
+                                 self.curApp.options))
+            self.curApp = None
+
+
+def IterConfig(file, chunkSize=65536):
+    """ Iterate over the application sections of a configuration file.
+
+    Yields one (device, app, options) tuple per application section in
+    file order, as soon as the parser has seen the end of the section.
+    device is a DeviceConfig without a DRIConfig and with an empty list
+    of applications, app an AppConfig of that device and options its
+    dictionary of option settings. The file is read in chunks of
+    chunkSize bytes and no object graph is built, so memory use does
+    not grow with the file size.
+
+    Raises XMLError if the file is not a valid configuration file. """
+    reader = _ConfigRecordReader()
+    p = xml.parsers.expat.ParserCreate()
+    p.StartElementHandler = reader.startElement
+    p.EndElementHandler = reader.endElement
+    while True:
+        data = file.read(chunkSize)
+        try:
+            p.Parse(data, not data)
+        except xml.parsers.expat.ExpatError, problem:
+            raise XMLError("ExpatError: " + str(problem))
+        records = reader.records
+        reader.records = []
+        for record in records:
+            yield record
+        if not data:
+            break
+
+
+def IsUserConfig(config):
+    return config.fileName.startswith(os.environ["HOME"])
+
+
+def GetUserConfig(configList):
+    userConfigs = [config for config in configList if IsUserConfig(config)]
+    if not userConfigs:
+        return None
+    else:
+        return userConfigs[0]
+
+
+def GenNormalDeviceConfigs(configList, dpy):
+    """ Generate a list of normalized device configurations.
+
+    One device configuration for each installed device. Each contains
+    a default application configuration that explicitly sets all
+    options to their default values in order to override values in
+    previous less specific device sections. Then it appends
+    application configurations for all application configurations in
+    all configuration files that affect the respective device. The
+    result is one device configuration per existing device that
+    summarizes the entire configuration of existing devices and
+    overrides any previous settings.
+
+    If there is no user configuration file, an empty list is returned.
+
+    Device sections are matched through hash indexes, so the run time
+    is linear in the size of the configuration. """
+    userConfig = GetUserConfig(configList)
+    if not userConfig:
+        return []
+    screens = [screen for screen in dpy.screens if screen]
+    deviceConfigs = []
+    # (deviceConfig, driver) tuples indexed by (screen, driver), screen
+    # and driver
+    allDevices = []
+    byScreenDriver = {}
+    byScreen = {}
+    byDriver = {}
+    # Create one device configuration for each installed device on this display
+    for screen in screens:
+        driver = screen.driver
+        deviceConfig = DeviceConfig(userConfig, str(screen.num), driver.name)
+        defaultApp = AppConfig(deviceConfig, "Default")
+        deviceConfig.addApp(defaultApp)
+        for sect in driver.optSections:
+            for opt in sect.options.values():
+                defaultApp.options[opt.name] = ValueToStr(opt.default,
+                                                          opt.type)
+        deviceConfig.isNormalized = True
+        deviceConfigs.append(deviceConfig)
+        entry = (deviceConfig, driver)
+        allDevices.append(entry)
+        byScreenDriver.setdefault((deviceConfig.screen, driver.name),
+                                  []).append(entry)
+        byScreen.setdefault(deviceConfig.screen, []).append(entry)
+        byDriver.setdefault(driver.name, []).append(entry)
+    for config in configList:
+        configIsUser = IsUserConfig(config)
+        for device in config.devices:
+            # Determine all installed devices affected by this device-section
+            # in the original configuration file
+            if device.screen != None and device.driver != None:
+                curDeviceConfigs = byScreenDriver.get(
+                    (device.screen, device.driver), ())
+            elif device.screen != None:
+                curDeviceConfigs = byScreen.get(device.screen, ())
+            elif device.driver != None:
+                curDeviceConfigs = byDriver.get(device.driver, ())
+            else:
+                curDeviceConfigs = allDevices
+            # Non-existing options or invalid values are only considered
+            # in redundant device sections.
+            checkOptions = not (configIsUser and device.screen != None and
+                                device.driver != None)
+            for curDevice, driver in curDeviceConfigs:
+                for app in device.apps:
+                    # Determine all applications on this device affected by
+                    # this application section in the original config file.
+                    # It should be one at most. Create a new application
+                    # configuration if needed.
+                    curApp = curDevice.getApp(app.executable)
+                    if curApp == None:
+                        curApp = AppConfig(curDevice, app.name,
+                                           app.executable)
+                        curDevice.addApp(curApp)
+                    # Update all option settings.
+                    options = curApp.options
+                    for opt, value in app.options.items():
+                        if checkOptions:
+                            optInfo = driver.getOptInfo(opt)
+                            if not optInfo or not optInfo.validate(value):
+                                continue
+                        options[opt] = value
+    return deviceConfigs
+
+
+def RemoveRedundantDevices(config, normalDeviceConfigs, onlyTest=False):
+    """ Remove device configurations that are redundant ...
+
+    ... after appending normalized device configurations. If onlyTest
+    is True, the configuration file is not modified and this function
+    returns True iff there are redundant device sections. Otherwise
+    False is returned. """
+    # The driver of the first normalized device configuration per screen
+    drivers = {}
+    for device in normalDeviceConfigs:
+        drivers.setdefault(device.screen, device.driver)
+    # A device section is redundant if there is a normalized device
+    # configuration for this device.
+    keep = [device for device in config.devices
+            if device.isNormalized or device.screen == None or
+            device.driver == None or
+            drivers.get(device.screen) != device.driver]
+    if len(keep) == len(config.devices):
+        return False
+    if onlyTest:
+        return True
+    # Remove redundant device sections in place, the user interfaces
+    # may hold references to the list.
+    config.devices[:] = keep
+    config.isModified = True
+    return False
+
+
+def IsRedundant(configList, dpy, normalDeviceConfigs=None):
+    """ Check if the user configuration is redundant.
+
+    Returns True iff there is a user configuration file that would
+    contain redundant device configurations after appending
+    normalDeviceConfigs. """
+    userConfig = GetUserConfig(configList)
+    if not userConfig:
+        return False
+    if normalDeviceConfigs == None:
+        normalDeviceConfigs = GenNormalDeviceConfigs(configList, dpy)
+    return RemoveRedundantDevices(userConfig, normalDeviceConfigs,
+                                  onlyTest=True)
+
+
+def NormalFingerprint(configList, dpy):
+    """ Hash of everything normalization depends on.
+
+    That is the screens and driver options of the display and the
+    contents of all configuration files. Returns None if a configuration
+    was not read from a file. """
+    digest = hashlib.sha1("v%d" % normalCacheVersion)
+    for screen in dpy.screens:
+        if screen == None:
+            digest.update(" -")
+        else:
+            digest.update(" %d:%s:%s" % (screen.num, screen.driver.name,
+                                         screen.driver.fingerprint()))
+    for config in configList:
+        if config.digest == None:
+            return None
+        if IsUserConfig(config):
+            digest.update(" u:" + config.digest)
+        else:
+            digest.update(" s:" + config.digest)
+    return digest.hexdigest()
+
+
+def _SpecificDevices(userConfig, dpy):
+    """ Helper: the specific device configurations for each screen at
+    the end of the user configuration file or None if a screen is not
+    configured. """
+    userDevs = userConfig.devices
+    # Find a consistent list of specific device configurations at the
+    # end of the user configuration file.
+    i = len(userDevs) - 1
+    while i >= 0 and userDevs[i].screen != None and userDevs[i].driver != None:
+        i = i - 1
+    i = i + 1
+    specificDevs = userDevs[i:]
+    # Make sure there is at least one for each configurable screen.
+    # If there are several the last one counts.
+    screens = [screen for screen in dpy.screens if screen]
+    screenDevs = [None for i in range(len(screens))]
+    for device in specificDevs:
+        screenNum = int(device.screen)
+        if screenNum >= len(screenDevs):
+            continue
+        if screens[screenNum].driver.name == device.driver:
+            screenDevs[screenNum] = device
+    if [None for device in screenDevs if device == None]:
+        return None  # There are unconfigured screens
+    return screenDevs
+
+
+def _IsKnownNormalized(configList, dpy, userConfig):
+    """ Helper: check if NormalizeConfig found the same configuration
+    normalized before.
+
+    The fingerprint only covers the files as they were read, so this is
+    never the case if a configuration was modified since. """
+    for config in configList:
+        if getattr(config, "isModified", False):
+            return False
+    fingerprint = _ReadNormalCache(userConfig.fileName)
+    return fingerprint != None and \
+           fingerprint == NormalFingerprint(configList, dpy)
+
+
+def IsNormalized(configList, dpy, normalDeviceConfigs=None):
+    """ Check if the user configuration file is normalized ...
+
+    ... in a set of configuration files, that is if the user
+    configuration file would be the same (except for names) after
+    normalization. If the user configuration file is normalized, a
+    list of existing normalized device configurations is returned. If
+    there is no user configuration file, an empty list is
+    returned. Otherwise, if there is a user configuration file that is
+    not normalized, this function returns None."""
+    userConfig = GetUserConfig(configList)
+    if not userConfig:
+        return []
+    screenDevs = _SpecificDevices(userConfig, dpy)
+    if screenDevs == None:
+        return None
+    if normalDeviceConfigs == None:
+        normalDeviceConfigs = GenNormalDeviceConfigs(configList, dpy)
+    # Compare existing normalized device configs with generated
+    # ones. If they are equivalent, the configuration file is
+    # normalized.
+    for device, normalDev in zip(screenDevs, normalDeviceConfigs):
+        # Check that the first executable is None and that each
+        # executable is configured exactly once.
+        if not device.apps or device.apps[0].executable != None or \
+           len(device.apps) != len(normalDev.apps):
+            return None
+        # Now check that each application contains the same option settings
+        # as the generated normalized configuration
+        for normalApp in normalDev.apps:
+            apps = device.appsByExecutable.get(normalApp.executable)
+            if not apps or len(apps) != 1 or \
+               apps[0].options != normalApp.options:
+                return None
+    # The configuration is normalized. Return the list of normalized device
+    # configurations from the user configuration files.
+    return screenDevs
+
+
+def NormalizeConfig(configList, dpy):
+    """ Normalize the user configuration file (if it exists) ...
+
+    ... by appending normalized device configurations for each
+    installed device and removing redundant device configurations. If
+    the user configuration file is already normalized, only existing
+    normalized device configurations are marked as such and redundant
+    device configurations are removed.
+
+    If the user configuration file is found to be normalized and left
+    unmodified, the fingerprint of the configuration is remembered in
+    the cache directory. If the files are unchanged and unmodified next
+    time, normalized device configurations are not generated again. """
+    userConfig = GetUserConfig(configList)
+    if not userConfig:
+        return []
+    if useNormalCache and _IsKnownNormalized(configList, dpy, userConfig):
+        existingDeviceConfigs = _SpecificDevices(userConfig, dpy)
+        if existingDeviceConfigs:
+            for deviceConfig in existingDeviceConfigs:
+                deviceConfig.isNormalized = True
+            return existingDeviceConfigs
+    newDeviceConfigs = GenNormalDeviceConfigs(configList, dpy)
+    existingDeviceConfigs = IsNormalized(configList, dpy, newDeviceConfigs)
+    if not existingDeviceConfigs and not newDeviceConfigs:
+        return []
+    if existingDeviceConfigs:
+        # is already normalized, mark existing normalized device
+        # configurations as such.
+        for deviceConfig in existingDeviceConfigs:
+            deviceConfig.isNormalized = True
+        deviceConfigs = existingDeviceConfigs
+    elif newDeviceConfigs:
+        userConfig.devices.extend(newDeviceConfigs)
+        userConfig.isModified = True
+        deviceConfigs = newDeviceConfigs
+    # Remove redundant device configurations from the user
+    # configuration file
+    RemoveRedundantDevices(userConfig, deviceConfigs)
+    if useNormalCache and existingDeviceConfigs and \
+           not getattr(userConfig, "isModified", False):
+        fingerprint = NormalFingerprint(configList, dpy)
+        if fingerprint != None:
+            _WriteNormalCache(userConfig.fileName, fingerprint)
+    return deviceConfigs
+
+
+class ConfigResolver(object):
+    """ Computes the option values an application gets.
+
+    The configuration files in configList are compiled into tables of
+    option settings keyed by the screen and driver of their device
+    section and the executable of their application section. Every
+    setting remembers its position in the configuration files, so that
+    later settings override earlier ones like in the driver's own
+    configuration parser.
+
+    If trace is True, the origin of every setting is recorded, so that
+    explain can tell where resolved values come from. """
+
+    __slots__ = ("configList", "devices", "origins")
+
+    def __init__(self, configList, trace=False):
+        self.configList = configList
+        # (screen, driver) -> (generic settings, executable -> settings)
+        # Settings are lists of (position, name, value) tuples. screen
+        # and driver are None for device sections that apply to all.
+        self.devices = {}
+        # (config index, device index, application index) by position
+        if trace:
+            self.origins = []
+        else:
+            self.origins = None
+        origins = self.origins
+        pos = 0
+        for c, config in enumerate(configList):
+            for d, device in enumerate(config.devices):
+                key = (device.screen, device.driver)
+                entry = self.devices.get(key)
+                if entry == None:
+                    entry = ([], {})
+                    self.devices[key] = entry
+                generic, byExecutable = entry
+                for a, app in enumerate(device.apps):
+                    if app.executable == None:
+                        settings = generic
+                    else:
+                        settings = byExecutable.setdefault(app.executable, [])
+                    for name, value in app.options.items():
+                        settings.append((pos, name, value))
+                        pos = pos + 1
+                    if origins != None:
+                        origins.extend([(c, d, a)] * len(app.options))
+
+    def keys(self, screen, driver):
+        """ Helper: keys of device sections that apply to screen and
+        driver in the order of increasing precedence. """
+        if screen != None:
+            screen = str(screen)
+        keys = [(None, None)]
+        if driver != None:
+            keys.append((None, driver))
+        if screen != None:
+            keys.append((screen, None))
+            if driver != None:
+                keys.append((screen, driver))
+        return keys
+
+    def candidates(self, screen, driver, executable):
+        """ Lists of settings that apply to screen, driver and
+        executable. """
+        result = []
+        for key in self.keys(screen, driver):
+            entry = self.devices.get(key)
+            if entry == None:
+                continue
+            generic, byExecutable = entry
+            if generic:
+                result.append(generic)
+            settings = byExecutable.get(executable)
+            if settings:
+                result.append(settings)
+        return result
+
+    def base(self, screen, driver, driverInfo=None):
+        """ Helper: values and positions for all applications.
+
+        Returns a (values, positions) tuple for the settings of generic
+        application sections. """
+        values = {}
+        if driverInfo != None:
+            for name, opt in driverInfo.optIndex.items():
+                values[name] = ValueToStr(opt.default, opt.type)
+        positions = {}
+        self.merge(values, positions,
+                   self.candidates(screen, driver, None), driverInfo)
+        return values, positions
+
+    def merge(self, values, positions, candidates, driverInfo):
+        """ Helper: merge candidate settings into values and positions. """
+        if driverInfo != None:
+            optIndex = driverInfo.optIndex
+        for settings in candidates:
+            for pos, name, value in settings:
+                if positions.get(name, -1) > pos:
+                    continue
+                if driverInfo != None:
+                    opt = optIndex.get(name)
+                    if opt == None or not opt.validate(value):
+                        continue
+                positions[name] = pos
+                values[name] = value
+
+    def resolveMany(self, screen, driver, executables, driverInfo=None):
+        """ Resolve the option values of many executables on screen.
+
+        The settings of generic application sections are merged only
+        once. Yields an (executable, values) tuple for every executable,
+        see resolve. """
+        baseValues, basePositions = self.base(screen, driver, driverInfo)
+        byExecutables = []
+        for key in self.keys(screen, driver):
+            entry = self.devices.get(key)
+            if entry != None and entry[1]:
+                byExecutables.append(entry[1])
+        for executable in executables:
+            candidates = []
+            for byExecutable in byExecutables:
+                settings = byExecutable.get(executable)
+                if settings:
+                    candidates.append(settings)
+            if not candidates:
+                yield executable, baseValues.copy()
+                continue
+            values = baseValues.copy()
+            self.merge(values, basePositions.copy(), candidates, driverInfo)
+            yield executable, values
+
+    def resolve(self, screen, driver, executable, driverInfo=None):
+        """ Return the option values executable gets on screen.
+
+        Returns a dictionary mapping option names to value strings. If
+        driverInfo is given, the result starts with the driver's
+        default values and settings of unknown options or with invalid
+        values are ignored. """
+        for executable, values in self.resolveMany(screen, driver,
+                                                   [executable], driverInfo):
+            return values
+
+    def explain(self, screen, driver, executable, driverInfo=None):
+        """ Tell where the option values executable gets come from.
+
+        Returns a dictionary mapping option names to (value, origin)
+        tuples. origin is None for driver defaults. Otherwise it is a
+        (fileName, deviceIndex, appIndex, line) tuple. line is the line
+        of the option setting if the file was parsed with trackLines,
+        else the line of the application section.
+
+        Raises an Error if the resolver was created without trace. """
+        if self.origins == None:
+            raise Error("configuration resolver created without trace")
+        values, positions = self.base(screen, driver, driverInfo)
+        self.merge(values, positions,
+                   self.candidates(screen, driver, executable), driverInfo)
+        result = {}
+        for name, value in values.items():
+            pos = positions.get(name)
+            if pos == None:
+                result[name] = (value, None)
+                continue
+            c, d, a = self.origins[pos]
+            config = self.configList[c]
+            app = config.devices[d].apps[a]
+            line = app.line
+            if app.optionLines != None and app.optionLines.has_key(name):
+                line = app.optionLines[name]
+            result[name] = (value, (config.fileName, d, a, line))
         return result
+
+
+def ResolveExecutables(resolver, targets, executables):
+    """ Resolve the option values of many executables on many screens.
+
+    targets is a list of (screen, driver, driverInfo) tuples, resolver
+    a ConfigResolver. Yields (screen, driver, executable, values)
+    tuples, see ConfigResolver.resolve. """
+    for screen, driver, driverInfo in targets:
+        for executable, values in resolver.resolveMany(screen, driver,
+                                                       executables,
+                                                       driverInfo):
+            yield screen, driver, executable, values
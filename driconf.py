@@ -26,31 +26,55 @@ pygtk.require("2.0")
 import gtk
 import gobject
 import argparse
-
-if gtk.check_version(2, 4, 0):
-    print "Error: DRIconf requires GTK 2.4 or newer."
-    sys.exit(1)
+import atexit
 
 import driconf_commonui
-import driconf_complexui
-import driconf_simpleui
+import driconf_profile
 
 commonui = driconf_commonui  # short cuts
-complexui = driconf_complexui
-simpleui = driconf_simpleui
+profile = driconf_profile
 
 from driconf_commonui import _
 
 
+def reportProfile(profiler, traceFileName):
+    profiler.set("probe processes", dri.spawnCount)
+    profiler.set("probe wall time (ms)",
+                 sum([wallTime for argv, wallTime, status in dri.probeLog])
+                 * 1000.0)
+    profiler.printSummary()
+    if traceFileName:
+        profiler.writeTrace(traceFileName)
+
+
 def main():
+    if gtk.check_version(2, 4, 0):
+        print "Error: DRIconf requires GTK 2.4 or newer."
+        sys.exit(1)
+
     parser = argparse.ArgumentParser(description='Customize performance and visual quality settings of OpenGL drivers on a per-driver, per-screen and/or per-application level.')
     parser.add_argument("-e", "--expert", help="Start driconf in Expert Mode", action="store_true", dest="expertui")
+    parser.add_argument("--no-cache", help="Don't use cached driver option information and normalization state", action="store_false", dest="useCache")
+    # Used by the startup benchmark: quit after the main window was drawn
+    parser.add_argument("--exit-after-startup", help=argparse.SUPPRESS, action="store_true", dest="exitAfterStartup")
+    # Used by the startup benchmark: system configuration file to use
+    # instead of /etc/drirc
+    parser.add_argument("--system-config", help=argparse.SUPPRESS, default="/etc/drirc", dest="systemConfig")
+    parser.add_argument("--profile", help="Print startup timings and counters on exit", action="store_true", dest="profile")
+    parser.add_argument("--profile-trace", metavar="FILE", help="Write startup timings to FILE in Chrome trace event format", dest="profileTrace")
     args = parser.parse_args()
     expert = args.expertui
+    if not args.useCache:
+        dri.useSchemaCache = False
+        dri.useNormalCache = False
+    if args.profile or args.profileTrace:
+        atexit.register(reportProfile, profile.enable(), args.profileTrace)
+    profiler = profile.profiler
 
     # read configuration information from the drivers
+    profiler.begin("probe display")
     try:
-        commonui.dpy = dri.DisplayInfo()
+        commonui.dpy = dri.DisplayInfo(parallel=True, batch=True)
     except dri.DRIError, problem:
         dialog = gtk.MessageDialog(None, 0, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK,
                                    str(problem))
@@ -67,6 +91,7 @@ def main():
         dialog.run()
         dialog.destroy()
         return
+    profiler.end("probe display")
 
     configScreens = [screen for screen in commonui.dpy.screens
                      if screen != None]
@@ -80,7 +105,9 @@ def main():
         expert = True
 
     # read or create configuration files
-    fileNameList = ["/etc/drirc", os.path.join(os.environ["HOME"], ".drirc")]
+    profiler.begin("read config files")
+    fileNameList = [args.systemConfig,
+                    os.path.join(os.environ["HOME"], ".drirc")]
     configList = []
     newFiles = []
     for fileName in fileNameList:
@@ -94,7 +121,7 @@ def main():
                 device = dri.DeviceConfig(config, str(screen.num),
                                           screen.driver.name)
                 app = dri.AppConfig(device, "all")
-                device.apps.append(app)
+                device.addApp(app)
                 config.devices.append(device)
             # Try to write the new file. If it fails, don't add this config.
             try:
@@ -102,11 +129,12 @@ def main():
             except IOError:
                 config = None
             else:
-                file.write(str(config))
+                config.write(file)
                 file.close()
                 newFiles.append(fileName)
         else:
             # Try to parse the configuration file.
+            profiler.count("parsed bytes", os.fstat(cfile.fileno()).st_size)
             try:
                 config = dri.DRIConfig(cfile)
             except dri.XMLError, problem:
@@ -126,6 +154,7 @@ def main():
             cfile.close()
         if config:
             configList.append(config)
+    profiler.end("read config files")
 
     if len(configList) == 0:
         dialog = gtk.MessageDialog(
@@ -137,12 +166,32 @@ def main():
         return
 
     # open the main window
+    profiler.begin("user interface")
+    # Only the user interface that is used is imported.
     if expert:
-        complexui.start(configList)
+        import driconf_complexui
+        driconf_complexui.start(configList)
     else:
-        simpleui.start(configList)
-
-    if len(newFiles) == 1:
+        import driconf_simpleui
+        driconf_simpleui.start(configList)
+    profiler.end("user interface")
+    if args.profile or args.profileTrace:
+        profile.countObjects(configList, commonui.dpy)
+
+    profiler.begin("first draw")
+
+    def firstDraw(widget, event):
+        profiler.end("first draw")
+        widget.disconnect(exposeHandler[0])
+        if args.exitAfterStartup:
+            gobject.idle_add(gtk.main_quit)
+        return False
+    exposeHandler = [commonui.mainWindow.connect("expose-event", firstDraw)]
+
+    if args.exitAfterStartup:
+        # Don't wait forever if the main window is never exposed
+        gobject.timeout_add(10000, gtk.main_quit)
+    elif len(newFiles) == 1:
         dialog = gtk.MessageDialog(
             commonui.mainWindow, gtk.DIALOG_DESTROY_WITH_PARENT,
             gtk.MESSAGE_INFO, gtk.BUTTONS_OK,
@@ -0,0 +1,907 @@
+#!/usr/bin/env python2
+
+# Benchmarks for the DRI configuration modules
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Run "python driconf_bench.py" in the source directory to run all
+# benchmarks or "python driconf_bench.py <name> ..." to run some of
+# them. Only the probe benchmark needs a display. Use --save-baseline
+# to store the results and --compare to check a later run against them.
+#
+# The startup benchmark needs Xvfb and python-gtk2. It runs driconf on a
+# virtual X server with replayed probe output.
+#
+# "python driconf_bench.py --gen-topology DIR" writes probe output for a
+# synthetic display to DIR. Run driconf with DRICONF_PROBE=replay:DIR to
+# use it.
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import shutil
+import subprocess
+from distutils.spawn import find_executable
+import cPickle
+import cStringIO
+import json
+import math
+import dri
+
+# Results of all benchmarks run so far: name -> (value, unit)
+results = {}
+
+# Import time budget per module in ms, including everything the module
+# imports. Modules that can't be imported (e.g. without GTK) are skipped.
+importBudget = [("dri", 40.0), ("driconf_profile", 20.0),
+                ("driconf_cli", 60.0), ("driconf_commonui", 300.0),
+                ("driconf_simpleui", 350.0), ("driconf_complexui", 350.0),
+                ("driconf", 350.0)]
+
+# Names of benchmark results that exceeded their budget
+overBudget = []
+
+
+def opsPerSec(func, minTime=0.5):
+    """ Call func repeatedly for at least minTime seconds.
+
+    func performs one or more operations per call and returns the
+    number of operations. Returns the number of operations per second. """
+    ops = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < minTime:
+        ops = ops + func()
+        elapsed = time.time() - start
+    return ops / elapsed
+
+
+def report(name, value, unit=""):
+    results[name] = (value, unit)
+    if isinstance(value, int):
+        print "%-44s %14d %s" % (name, value, unit)
+    else:
+        print "%-44s %14.1f %s" % (name, value, unit)
+
+
+def currentRSS():
+    """ Current resident set size of this process in bytes. """
+    statm = open("/proc/self/statm").read().split()
+    return int(statm[1]) * resource.getpagesize()
+
+
+def resetPeakRSS():
+    """ Reset the peak resident set size of this process to the current
+    one. Returns False if the kernel doesn't support that. """
+    try:
+        out = open("/proc/self/clear_refs", "w")
+        out.write("5")
+        out.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peakRSS():
+    """ Peak resident set size of this process in bytes. """
+    for line in open("/proc/self/status"):
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memoryUsed(func, arg=None):
+    """ Memory used by func(arg) in bytes.
+
+    This is the peak resident set size during the call above the
+    resident set size before it. If the peak can't be reset, the
+    growth of the current resident set size is used. ru_maxrss alone
+    doesn't work, its peak is usually set before func is called. """
+    before = currentRSS()
+    if resetPeakRSS():
+        func(arg)
+        return peakRSS() - before
+    # Keep the result alive while measuring
+    result = func(arg)
+    return currentRSS() - before
+
+
+def inChild(func):
+    """ Call func in a forked child process and return its result.
+
+    This gives each measurement of the peak memory usage a fresh
+    start. """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = func()
+        except:
+            result = None
+        os.write(write, cPickle.dumps(result))
+        os._exit(0)
+    os.close(write)
+    data = ""
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        data = data + chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    return cPickle.loads(data)
+
+
+def genConfig(nApps, appsPerDevice=100, optsPerApp=4):
+    """ Generate a drirc with nApps application sections. """
+    lines = ['<driconf>']
+    nDevices = (nApps + appsPerDevice - 1) / appsPerDevice
+    for d in range(nDevices):
+        lines.append('    <device screen="%d" driver="drv%d">' % (d % 4, d % 3))
+        for a in range(d * appsPerDevice, min(nApps, (d + 1) * appsPerDevice)):
+            lines.append('        <application name="App %d" '
+                         'executable="app%d">' % (a, a))
+            for o in range(optsPerApp):
+                lines.append('            <option name="opt%d" value="%d" />' %
+                             ((a + o) % 32, o))
+            lines.append('        </application>')
+        lines.append('    </device>')
+    lines.append('</driconf>')
+    return "\n".join(lines) + "\n"
+
+
+languages = ["en", "de", "es", "it", "ru", "fr", "nl", "sv", "ca", "pt",
+             "ja", "zh", "ko", "fi", "pl", "cs"]
+
+
+def genDriverOptions(nSections=4, optsPerSection=25, nLangs=4):
+    """ Generate xdriinfo options output for a synthetic driver.
+
+    Options are named opt0, opt1, ... like the options in genConfig.
+    Their types alternate between bool, enum, int with many ranges and
+    float. Every description is given in nLangs languages. """
+    langs = languages[:nLangs] + ["x%d" % i
+                                  for i in range(nLangs - len(languages))]
+    lines = ['<driinfo>']
+    n = 0
+    for s in range(nSections):
+        lines.append('<section>')
+        for lang in langs:
+            lines.append('<description lang="%s" text="Section %d (%s)"/>' %
+                         (lang, s, lang))
+        for o in range(optsPerSection):
+            kind = n % 4
+            if kind == 0:
+                lines.append('<option name="opt%d" type="bool" '
+                             'default="false">' % n)
+            elif kind == 1:
+                nEnums = 2 + n % 7
+                lines.append('<option name="opt%d" type="enum" default="0" '
+                             'valid="0:%d">' % (n, nEnums - 1))
+            elif kind == 2:
+                ranges = ["%d:%d" % (r * 1000, r * 1000 + 500)
+                          for r in range(1 + n % 16)]
+                lines.append('<option name="opt%d" type="int" default="0" '
+                             'valid="%s">' % (n, ",".join(ranges)))
+            else:
+                lines.append('<option name="opt%d" type="float" '
+                             'default="0.0" valid="-1e6:1e6">' % n)
+            for lang in langs:
+                if kind != 1:
+                    lines.append('<description lang="%s" text="Option %d '
+                                 '(%s)"/>' % (lang, n, lang))
+                    continue
+                lines.append('<description lang="%s" text="Option %d (%s)">'
+                             % (lang, n, lang))
+                for e in range(nEnums):
+                    lines.append('<enum value="%d" text="Value %d (%s)"/>' %
+                                 (e, e, lang))
+                lines.append('</description>')
+            lines.append('</option>')
+            n = n + 1
+        lines.append('</section>')
+    lines.append('</driinfo>')
+    return "\n".join(lines) + "\n"
+
+
+def genTopology(directory, nScreens=1, nDrivers=1, nSections=4,
+                optsPerSection=25, nLangs=4, nNonDRI=0):
+    """ Write probe output for a synthetic display to directory.
+
+    The display has nScreens screens. The first nScreens - nNonDRI
+    screens are driven by drivers drv0 ... drv<nDrivers - 1> in turn,
+    the others are not direct rendering capable. The directory can be
+    used with dri.ReplayBackend. """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def put(key, data):
+        out = open(os.path.join(directory, key), "w")
+        out.write(data)
+        out.close()
+
+    put("xdriinfo-nscreens", "%d\n" % nScreens)
+    listing = []
+    for i in range(nScreens):
+        if i >= nScreens - nNonDRI:
+            listing.append("Screen %d: not direct rendering capable.\n" % i)
+            put("xdriinfo-driver-%d.err" % i,
+                "screen %d: not direct rendering capable\n" % i)
+            continue
+        driver = "drv%d" % (i % nDrivers)
+        listing.append("Screen %d: %s\n" % (i, driver))
+        put("xdriinfo-driver-%d" % i, driver + "\n")
+        glxInfo = ("name of display: :0\n"
+                   "display: :0  screen: %d\n"
+                   "direct rendering: Yes\n"
+                   "OpenGL vendor string: Synthetic\n"
+                   "OpenGL renderer string: Synthetic %s on screen %d\n"
+                   "OpenGL version string: 3.0\n" % (i, driver, i))
+        put("glxinfo-B.%d" % i, glxInfo)
+        put("glxinfo.%d" % i, glxInfo)
+    put("xdriinfo", "".join(listing))
+    for d in range(min(nDrivers, nScreens - nNonDRI)):
+        put("xdriinfo-options-drv%d" % d,
+            genDriverOptions(nSections, optsPerSection, nLangs))
+
+
+def writeTempFile(data, suffix=".drirc"):
+    """ Write data to a temporary file and return its name. """
+    fd, fileName = tempfile.mkstemp(suffix)
+    os.write(fd, data)
+    os.close(fd)
+    return fileName
+
+
+def parseConfig(fileName):
+    cfile = open(fileName, "r")
+    config = dri.DRIConfig(cfile)
+    cfile.close()
+    return config
+
+
+def timePerRun(func, setup=None, minTime=0.5):
+    """ Time func without the time spent in setup.
+
+    setup is called before each call of func and its result is passed
+    to func. Returns the average time per call of func in seconds. """
+    runs = 0
+    elapsed = 0.0
+    while elapsed < minTime or runs < 3:
+        if setup != None:
+            arg = setup()
+            start = time.time()
+            func(arg)
+        else:
+            start = time.time()
+            func()
+        elapsed = elapsed + time.time() - start
+        runs = runs + 1
+    return elapsed / runs
+
+
+def peakMemory(func, setup=None):
+    """ Peak memory used by one call of func in a fresh process. """
+
+    def measure():
+        if setup != None:
+            return memoryUsed(func, setup())
+        return memoryUsed(lambda arg: func())
+
+    return inChild(measure)
+
+
+def scalingExponent(sizes, times):
+    """ Least squares fit of times = c * sizes ** k. Returns k. """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(t) for t in times]
+    n = len(xs)
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum([(x - mx) ** 2 for x in xs])
+    sxy = sum([(x - mx) * (y - my) for x, y in zip(xs, ys)])
+    return sxy / sxx
+
+
+def measureScaling(name, unit, sizes, func, setup=None):
+    """ Run func on inputs of increasing size.
+
+    setup(size) returns a function that prepares one call of func on
+    an input of that size. Reports the throughput in unit per second
+    for each size, the peak memory for the largest size and the
+    scaling exponent of the run time. """
+    times = []
+    for size in sizes:
+        t = timePerRun(func, setup(size))
+        times.append(t)
+        report("%s (%d %s)" % (name, size, unit), size / t, unit + "/s")
+    report("%s peak memory (%d %s)" % (name, sizes[-1], unit),
+           peakMemory(func, setup(sizes[-1])), "bytes")
+    if len(sizes) > 1:
+        report("%s scaling exponent" % name, scalingExponent(sizes, times))
+
+
+def legacyValidate(opt, str):
+    """ Option validation as it was done before validators were compiled. """
+    try:
+        v = dri.StrToValue(str, opt.type)
+    except dri.XMLError:
+        return 0
+    if opt.valid:
+        for r in opt.valid:
+            if v >= r.start and v <= r.end:
+                return 1
+        return 0
+    else:
+        return 1
+
+
+def benchValidate():
+    """ Validation of option values: legacy, compiled and cached, with
+    and without hits in the validation cache. """
+    opts = [dri.OptInfo("ranges", "int", "4",
+                        "0:2,4,8:16,32,64,100:200,256,512,1024"),
+            dri.OptInfo("single", "float", "0.0", "-4.0:4.0"),
+            dri.OptInfo("enum", "enum", "1", "0:3"),
+            dri.OptInfo("bool", "bool", "false")]
+    repeated = {"ranges": ["3", "12", "150", "1024", "x"],
+                "single": ["-1.5", "0.0", "5", "nan"],
+                "enum": ["0", "3", "4"],
+                "bool": ["true", "false", "yes"]}
+    # More distinct strings than fit into the validation cache
+    unique = {}
+    for opt in opts:
+        if opt.type == "bool":
+            unique[opt.name] = repeated[opt.name]
+        else:
+            unique[opt.name] = [str(i) for i in
+                                range(-10, dri.validCacheSize * 4)]
+
+    for label, values in (("repeated", repeated), ("unique", unique)):
+        def legacy():
+            n = 0
+            for opt in opts:
+                for value in values[opt.name]:
+                    legacyValidate(opt, value)
+                n = n + len(values[opt.name])
+            return n
+
+        def compiled():
+            n = 0
+            for opt in opts:
+                validate = opt.validate
+                for value in values[opt.name]:
+                    validate(value)
+                n = n + len(values[opt.name])
+            return n
+
+        def cached():
+            n = 0
+            for opt in opts:
+                validate = opt.validateCached
+                for value in values[opt.name]:
+                    validate(value)
+                n = n + len(values[opt.name])
+            return n
+
+        before = opsPerSec(legacy)
+        after = opsPerSec(compiled)
+        report("validate %s values (legacy)" % label, before, "ops/s")
+        report("validate %s values (compiled)" % label, after, "ops/s")
+        report("validate %s values (cached)" % label, opsPerSec(cached),
+               "ops/s")
+        report("validate %s values speedup" % label, after / before, "x")
+
+
+def benchMemory(nApps=50000):
+    """ Memory used by a parsed configuration file with many
+    applications. """
+    fileName = writeTempFile(genConfig(nApps))
+
+    def measure():
+        return memoryUsed(parseConfig, fileName)
+
+    try:
+        used = inChild(measure)
+    finally:
+        os.remove(fileName)
+    report("memory per application (%d apps)" % nApps,
+           float(used) / nApps, "bytes")
+
+
+def legacyStr(config):
+    """ Serialization as it was done before DRIConfig.write existed. """
+    result = '<driconf>\n'
+    for d in config.devices:
+        dResult = '    <device'
+        if d.screen:
+            dResult = dResult + ' screen="' + d.screen + '"'
+        if d.driver:
+            dResult = dResult + ' driver="' + d.driver + '"'
+        dResult = dResult + '>\n'
+        for a in d.apps:
+            aResult = '        <application name="' + a.name + '"'
+            if a.executable != None:
+                aResult = aResult + ' executable="' + a.executable + '">\n'
+            else:
+                aResult = aResult + '>\n'
+            for n, v in a.options.items():
+                aResult = aResult + '            <option name="' + n + \
+                          '" value="' + v + '" />\n'
+            aResult = aResult + '        </application>'
+            dResult = dResult + aResult + '\n'
+        dResult = dResult + '    </device>'
+        result = result + dResult + '\n'
+    result = result + '</driconf>'
+    return result
+
+
+def benchSerialize(nApps=20000):
+    """ Serialization of a multi-megabyte configuration file. """
+    fileName = writeTempFile(genConfig(nApps))
+    try:
+        config = parseConfig(fileName)
+        size = os.path.getsize(fileName) / (1024.0 * 1024.0)
+
+        def legacy():
+            out = open(fileName, "w")
+            out.write(legacyStr(config))
+            out.close()
+            return 1
+
+        def streaming():
+            out = open(fileName, "w")
+            config.write(out)
+            out.close()
+            return 1
+
+        report("serialize %.1f MB (legacy)" % size, opsPerSec(legacy) * size,
+               "MB/s")
+        report("serialize %.1f MB (streaming)" % size,
+               opsPerSec(streaming) * size, "MB/s")
+    finally:
+        os.remove(fileName)
+
+
+def benchProbe():
+    """ Probing the display with xdriinfo and glxinfo in different
+    modes. The schema cache is disabled to time the actual probes. """
+    useSchemaCache = dri.useSchemaCache
+    dri.useSchemaCache = False
+    try:
+        for label, kw in (("sequential", {}),
+                          ("parallel", {"parallel": True}),
+                          ("batch", {"batch": True}),
+                          ("parallel batch", {"parallel": True,
+                                              "batch": True})):
+            dri.DisplayInfo.drivers.clear()
+            start = time.time()
+            try:
+                dpy = dri.DisplayInfo(**kw)
+            except dri.DRIError, problem:
+                print "probe: %s" % problem
+                return
+            elapsed = time.time() - start
+            report("probe %s" % label, elapsed * 1000.0, "ms")
+            report("probe %s processes" % label, dpy.spawnCount)
+            report("probe %s glxinfo runs avoided" % label,
+                   dpy.glxInfoAvoided())
+    finally:
+        dri.useSchemaCache = useSchemaCache
+
+
+def benchTopology():
+    """ Probing synthetic displays of increasing size from replayed
+    probe output. """
+    probeBackend = dri.probeBackend
+    try:
+        for nScreens, nDrivers in ((1, 1), (4, 2), (16, 4), (64, 8)):
+            directory = tempfile.mkdtemp()
+            try:
+                genTopology(directory, nScreens, nDrivers, 8, 50)
+                dri.probeBackend = dri.ReplayBackend(directory)
+                for label, kw in (("sequential", {}),
+                                  ("parallel batch", {"parallel": True,
+                                                      "batch": True})):
+                    dri.DisplayInfo.drivers.clear()
+                    start = time.time()
+                    dpy = dri.DisplayInfo(**kw)
+                    elapsed = time.time() - start
+                    report("topology %d screens %d drivers %s" %
+                           (nScreens, nDrivers, label), elapsed * 1000.0,
+                           "ms")
+            finally:
+                shutil.rmtree(directory)
+    finally:
+        dri.probeBackend = probeBackend
+        dri.DisplayInfo.drivers.clear()
+
+
+def startXvfb():
+    """ Start a virtual X server. Returns the process and display name. """
+    read, write = os.pipe()
+    server = subprocess.Popen(["Xvfb", "-displayfd", str(write), "-nolisten",
+                               "tcp", "-screen", "0", "1024x768x24"],
+                              stderr=open(os.devnull, "w"))
+    os.close(write)
+    number = ""
+    while True:
+        data = os.read(read, 16)
+        if not data:
+            break
+        number = number + data
+        if number.endswith("\n"):
+            break
+    os.close(read)
+    if not number.strip():
+        server.wait()
+        return None, None
+    return server, ":" + number.strip()
+
+
+def firstWindowTime(traceFileName):
+    """ Time from the start of driconf.main to the first draw of the
+    main window in ms, read from a --profile-trace file. Returns None
+    if the window was not drawn. """
+    for event in json.load(open(traceFileName))["traceEvents"]:
+        if event["name"] == "first draw" and event["ph"] == "X":
+            return (event["ts"] + event["dur"]) / 1000.0
+    return None
+
+
+def benchStartup(sizes=(10, 1000, 10000), runs=5):
+    """ Time from starting driconf to the first draw of the main window
+    in the simple and the expert UI, with user configuration files of
+    increasing size. A small system configuration file is used instead
+    of /etc/drirc. """
+    if not find_executable("Xvfb"):
+        print "startup: skipped (Xvfb not found)"
+        return
+    server, display = startXvfb()
+    if server == None:
+        print "startup: skipped (Xvfb failed to start)"
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        probeDir = os.path.join(directory, "probe")
+        genTopology(probeDir, 4, 3)
+        systemConfig = os.path.join(directory, "drirc")
+        out = open(systemConfig, "w")
+        out.write(genConfig(10))
+        out.close()
+        traceFile = os.path.join(directory, "trace.json")
+        env = dict(os.environ)
+        env["DISPLAY"] = display
+        env["HOME"] = directory
+        env["XDG_CACHE_HOME"] = os.path.join(directory, "cache")
+        env["DRICONF_PROBE"] = "replay:" + probeDir
+        sourceDir = os.path.dirname(os.path.abspath(__file__))
+        argv = [sys.executable, "-c", "import driconf; driconf.main()",
+                "--exit-after-startup", "--system-config", systemConfig,
+                "--profile-trace", traceFile]
+        for size in sizes:
+            drirc = genConfig(size)
+            for label, extra in (("simple", []), ("expert", ["--expert"])):
+                times = []
+                for i in range(runs):
+                    # Start from the same file, the simple UI normalizes it
+                    out = open(os.path.join(directory, ".drirc"), "w")
+                    out.write(drirc)
+                    out.close()
+                    if os.path.exists(traceFile):
+                        os.remove(traceFile)
+                    status = subprocess.call(argv + extra, cwd=sourceDir,
+                                             env=env,
+                                             stdout=open(os.devnull, "w"))
+                    if status != 0:
+                        print "startup %s: driconf failed with status %d" % \
+                              (label, status)
+                        return
+                    firstWindow = firstWindowTime(traceFile)
+                    if firstWindow == None:
+                        print "startup %s: main window was not drawn" % label
+                        return
+                    times.append(firstWindow)
+                times.sort()
+                report("startup %s UI to first window (%d apps)" %
+                       (label, size), times[len(times) / 2], "ms")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+importScript = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print elapsed, " ".join([name for name in sorted(sys.modules.keys())
+                          if name.startswith("driconf") or name == "gtk"])
+"""
+
+
+def benchImports(runs=5):
+    """ Import time of each module in a fresh interpreter, checked
+    against importBudget, and the modules loaded by it. """
+    sourceDir = os.path.dirname(os.path.abspath(__file__))
+    for module, budget in importBudget:
+        times = []
+        for i in range(runs):
+            child = subprocess.Popen(
+                [sys.executable, "-c", importScript % module],
+                cwd=sourceDir, stdout=subprocess.PIPE,
+                stderr=open(os.devnull, "w"))
+            output = child.communicate()[0].split()
+            if child.returncode != 0:
+                break
+            times.append(float(output[0]) * 1000.0)
+        if not times:
+            print "import %s: skipped (import failed)" % module
+            continue
+        times.sort()
+        name = "import %s" % module
+        report(name, times[len(times) / 2], "ms")
+        if times[len(times) / 2] > budget:
+            print "OVER BUDGET %s: budget %.1f ms" % (name, budget)
+            overBudget.append(name)
+        print "    loads %s" % (" ".join(output[1:]) or "no driconf modules")
+
+
+def benchSuite(sizes=(1000, 4000, 16000)):
+    """ Parsing, normalization, validation, serialization and
+    resolution of configuration files and driver information of
+    increasing size.
+    Probe output is replayed from a synthetic display with four screens
+    and the drivers used by genConfig. """
+    probeBackend = dri.probeBackend
+    useNormalCache = dri.useNormalCache
+    home = os.environ.get("HOME")
+    directory = tempfile.mkdtemp()
+    try:
+        genTopology(os.path.join(directory, "probe"), 4, 3, 2, 16)
+        dri.probeBackend = dri.ReplayBackend(os.path.join(directory,
+                                                          "probe"))
+        dri.DisplayInfo.drivers.clear()
+        dpy = dri.DisplayInfo()
+        drivers = dri.DisplayInfo.drivers
+        # Configuration files in $HOME are user configuration files
+        os.environ["HOME"] = directory
+        fileNames = {}
+        for size in sizes:
+            fileNames[size] = os.path.join(directory, "drirc%d" % size)
+            out = open(fileNames[size], "w")
+            out.write(genConfig(size))
+            out.close()
+
+        def parseSetup(size):
+            return lambda: fileNames[size]
+        measureScaling("parse config", "apps", sizes, parseConfig,
+                       parseSetup)
+
+        def driverSetup(size):
+            driInfo = genDriverOptions(size / 100, 100)
+            return lambda: driInfo
+        measureScaling("parse driver info", "options",
+                       [size / 10 for size in sizes],
+                       lambda driInfo: dri.DriverInfo("drv", driInfo),
+                       driverSetup)
+
+        def configSetup(size):
+            config = parseConfig(fileNames[size])
+            return lambda: config
+
+        def validateAll(config):
+            for device in config.devices:
+                driver = drivers.get(device.driver)
+                if driver == None:
+                    continue
+                for app in device.apps:
+                    driver.validate(app.options)
+        measureScaling("validate config", "apps", sizes, validateAll,
+                       configSetup)
+
+        def serialize(config):
+            config.write(cStringIO.StringIO())
+        measureScaling("serialize config", "apps", sizes, serialize,
+                       configSetup)
+
+        targets = [(screen.num, screen.driver.name, screen.driver)
+                   for screen in dpy.screens if screen != None]
+
+        def resolveSetup(size):
+            resolver = dri.ConfigResolver([parseConfig(fileNames[size])])
+            executables = ["app%d" % i for i in range(size)]
+            return lambda: (resolver, executables)
+
+        def resolveAll((resolver, executables)):
+            for result in dri.ResolveExecutables(resolver, targets,
+                                                 executables):
+                pass
+        measureScaling("resolve executables", "apps", sizes, resolveAll,
+                       resolveSetup)
+
+        def normalizeSetup(size):
+            return lambda: [parseConfig(fileNames[size])]
+        dri.useNormalCache = False
+        measureScaling("normalize config", "apps", sizes,
+                       lambda configList: dri.NormalizeConfig(configList,
+                                                              dpy),
+                       normalizeSetup)
+    finally:
+        dri.probeBackend = probeBackend
+        dri.useNormalCache = useNormalCache
+        dri.DisplayInfo.drivers.clear()
+        if home != None:
+            os.environ["HOME"] = home
+        shutil.rmtree(directory)
+
+
+def benchNormalize(sizes=(1250, 2500, 5000, 10000)):
+    """ Normalization of user configuration files with up to 10000
+    application sections in many small device sections, and recognizing
+    them as normalized afterwards by their fingerprint.
+
+    Probe output is replayed from a synthetic display with four screens
+    and three drivers. """
+    probeBackend = dri.probeBackend
+    useNormalCache = dri.useNormalCache
+    home = os.environ.get("HOME")
+    cacheHome = os.environ.get("XDG_CACHE_HOME")
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(directory, "cache")
+        genTopology(os.path.join(directory, "probe"), 4, 3, 2, 16)
+        dri.probeBackend = dri.ReplayBackend(os.path.join(directory,
+                                                          "probe"))
+        dri.DisplayInfo.drivers.clear()
+        dpy = dri.DisplayInfo()
+        # Configuration files in $HOME are user configuration files
+        os.environ["HOME"] = directory
+        fileNames = {}
+        for size in sizes:
+            fileNames[size] = os.path.join(directory, "drirc%d" % size)
+            out = open(fileNames[size], "w")
+            out.write(genConfig(size, appsPerDevice=10))
+            out.close()
+
+        def normalizeSetup(size):
+            return lambda: [parseConfig(fileNames[size])]
+        dri.useNormalCache = False
+        measureScaling("normalize user config", "apps", sizes,
+                       lambda configList: dri.NormalizeConfig(configList,
+                                                              dpy),
+                       normalizeSetup)
+
+        # Normalize once and save the result like the user interface
+        # does. Normalizing the saved file remembers its fingerprint.
+        dri.useNormalCache = True
+        for size in sizes:
+            config = parseConfig(fileNames[size])
+            dri.NormalizeConfig([config], dpy)
+            out = open(fileNames[size], "w")
+            config.write(out)
+            out.close()
+            dri.NormalizeConfig([parseConfig(fileNames[size])], dpy)
+        measureScaling("normalize unchanged user config", "apps", sizes,
+                       lambda configList: dri.NormalizeConfig(configList,
+                                                              dpy),
+                       normalizeSetup)
+    finally:
+        dri.probeBackend = probeBackend
+        dri.useNormalCache = useNormalCache
+        dri.DisplayInfo.drivers.clear()
+        if home != None:
+            os.environ["HOME"] = home
+        if cacheHome != None:
+            os.environ["XDG_CACHE_HOME"] = cacheHome
+        else:
+            del os.environ["XDG_CACHE_HOME"]
+        shutil.rmtree(directory)
+
+
+def isRegression(value, baseline, unit, tolerance):
+    """ Check if value is worse than baseline by more than tolerance. """
+    if unit.endswith("/s") or unit == "x":
+        return value < baseline * (1.0 - tolerance)
+    return value > baseline * (1.0 + tolerance)
+
+
+def compareBaseline(fileName, tolerance):
+    """ Compare results with a stored baseline.
+
+    Returns the number of regressions. """
+    baseline = json.load(open(fileName, "r"))
+    regressions = 0
+    for name in sorted(results.keys()):
+        if not baseline.has_key(name):
+            continue
+        value, unit = results[name]
+        old = baseline[name][0]
+        if old and isRegression(value, old, unit, tolerance):
+            print "REGRESSION %s: %g %s, baseline %g %s" % \
+                  (name, value, unit, old, unit)
+            regressions = regressions + 1
+    print "%d regressions compared to %s" % (regressions, fileName)
+    return regressions
+
+
+benchmarks = [("validate", benchValidate), ("memory", benchMemory),
+              ("serialize", benchSerialize), ("probe", benchProbe),
+              ("topology", benchTopology), ("suite", benchSuite),
+              ("normalize", benchNormalize),
+              ("startup", benchStartup), ("imports", benchImports)]
+
+
+def main():
+    names = [name for name, func in benchmarks]
+    parser = argparse.ArgumentParser(description="Benchmark DRIconf.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="Benchmarks to run: %s (default: all)" %
+                        ", ".join(names))
+    parser.add_argument("--save-baseline", metavar="FILE",
+                        help="Store the results as a baseline in FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="Compare the results with the baseline in "
+                        "FILE, exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative difference to the baseline that "
+                        "counts as a regression (default: 0.2)")
+    topology = parser.add_argument_group(
+        "synthetic display", "Write probe output for a synthetic display "
+        "instead of running benchmarks.")
+    topology.add_argument("--gen-topology", metavar="DIR",
+                          help="Directory to write the probe output to")
+    topology.add_argument("--screens", type=int, default=4,
+                          help="Number of screens (default: 4)")
+    topology.add_argument("--drivers", type=int, default=2,
+                          help="Number of distinct drivers (default: 2)")
+    topology.add_argument("--non-dri", type=int, default=0,
+                          help="Number of screens without direct "
+                          "rendering (default: 0)")
+    topology.add_argument("--sections", type=int, default=4,
+                          help="Option sections per driver (default: 4)")
+    topology.add_argument("--options", type=int, default=25,
+                          help="Options per section (default: 25)")
+    topology.add_argument("--languages", type=int, default=4,
+                          help="Languages per description (default: 4)")
+    args = parser.parse_args()
+    if args.gen_topology:
+        genTopology(args.gen_topology, args.screens, args.drivers,
+                    args.sections, args.options, args.languages,
+                    args.non_dri)
+        return
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark '%s'" % name)
+    for name, func in benchmarks:
+        if not args.benchmarks or name in args.benchmarks:
+            func()
+    if args.save_baseline:
+        out = open(args.save_baseline, "w")
+        json.dump(results, out, indent=1, sort_keys=True)
+        out.close()
+    if args.compare and compareBaseline(args.compare, args.tolerance):
+        sys.exit(1)
+    if overBudget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
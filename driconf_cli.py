@@ -0,0 +1,475 @@
+# DRI configuration: command line interface without GTK
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# This module must not import GTK. It is used by the driconf script for
+# the commands listed below, before the GUI is loaded.
+
+import sys
+import os
+import argparse
+import json
+import itertools
+import dri
+
+commands = ["list", "get", "set", "unset", "validate", "normalize",
+            "resolve", "explain"]
+
+# Compiled configuration and (screen, driver, driverInfo) tuples of the
+# resolve command. Worker processes are forked and inherit them.
+_resolver = None
+_targets = None
+
+
+class CommandError(Exception):
+    """ Errors reported to the user without a traceback """
+    pass
+
+
+def isCommand(argv):
+    """ Check if argv (without the program name) is a CLI command. """
+    return len(argv) > 0 and argv[0] in commands
+
+
+def userConfigFile():
+    return os.path.abspath(os.path.join(os.environ["HOME"], ".drirc"))
+
+
+def readConfig(fileName, mustExist=True, trackLines=False):
+    """ Parse a configuration file.
+
+    If mustExist is False, a missing file results in an empty
+    configuration. The configuration gets the absolute file name, so
+    that dri.IsUserConfig recognizes relative names of user
+    configuration files. """
+    path = os.path.abspath(fileName)
+    try:
+        cfile = open(path, "r")
+    except IOError, problem:
+        if mustExist:
+            raise CommandError("cannot read %s: %s" %
+                               (fileName, problem.strerror))
+        return dri.DRIConfig(None, path)
+    try:
+        try:
+            return dri.DRIConfig(cfile, trackLines=trackLines)
+        except dri.XMLError, problem:
+            raise CommandError("%s: %s" % (fileName, problem))
+    finally:
+        cfile.close()
+
+
+def writeConfig(config):
+    """ Replace the configuration file atomically. """
+    tmpName = "%s.%d.tmp" % (config.fileName, os.getpid())
+    try:
+        out = open(tmpName, "w")
+        try:
+            config.write(out)
+        finally:
+            out.close()
+        os.rename(tmpName, config.fileName)
+    except (IOError, OSError), problem:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise CommandError("cannot write %s: %s" %
+                           (config.fileName, problem.strerror))
+
+
+def readConfigList(fileNames, trackLines=False):
+    """ Parse the system and user configuration files, or fileNames. """
+    if not fileNames:
+        fileNames = [fileName for fileName in ["/etc/drirc", userConfigFile()]
+                     if os.path.exists(fileName)]
+    return [readConfig(fileName, trackLines=trackLines)
+            for fileName in fileNames]
+
+
+def findDevice(config, screen, driver, create=False):
+    """ Find the last device section for screen and driver. """
+    for device in config.devices[::-1]:
+        if device.screen == screen and device.driver == driver:
+            return device
+    if not create:
+        return None
+    device = dri.DeviceConfig(config, screen, driver)
+    config.devices.append(device)
+    return device
+
+
+def findApp(device, executable, name=None, create=False):
+    """ Find the last application section for executable. """
+    apps = device.appsByExecutable.get(executable)
+    if apps:
+        return max([(device.apps.index(app), app) for app in apps])[1]
+    if not create:
+        return None
+    if name == None:
+        name = executable or "all"
+    app = dri.AppConfig(device, name, executable)
+    device.addApp(app)
+    return app
+
+
+def getDisplayInfo(dpy):
+    try:
+        return dri.DisplayInfo(dpy, parallel=True, batch=True)
+    except (dri.DRIError, dri.XMLError), problem:
+        raise CommandError(str(problem))
+
+
+def cmdList(args):
+    """ List the screens of the display and their drivers. """
+    dpyInfo = getDisplayInfo(args.display)
+    for i in range(len(dpyInfo.screens)):
+        screen = dpyInfo.screens[i]
+        if screen == None:
+            print "screen %d: not configurable" % i
+            continue
+        print "screen %d: %s" % (i, screen.driver.name)
+        if not args.options:
+            continue
+        for section in screen.driver.optSections:
+            for opt in section.optList:
+                line = "    %s (%s) default %s" % \
+                       (opt.name, opt.type,
+                        dri.ValueToStr(opt.default, opt.type))
+                if opt.valid:
+                    line = line + " valid " + \
+                           ",".join([str(r) for r in opt.valid])
+                print line
+
+
+def cmdGet(args):
+    """ Print an option value of a device and application section. """
+    config = readConfig(args.file or userConfigFile())
+    device = findDevice(config, args.screen, args.driver)
+    app = device and findApp(device, args.executable)
+    if app == None or not app.options.has_key(args.option):
+        raise CommandError("option %s is not set" % args.option)
+    print app.options[args.option]
+
+
+def checkValue(driverName, option, value):
+    """ Validate a value against the driver, if the driver is known. """
+    if driverName == None:
+        return
+    try:
+        driver = dri.GetDriver(driverName, 0)
+    except (dri.DRIError, dri.XMLError):
+        # Driver information is not available, e.g. without display
+        return
+    optInfo = driver.getOptInfo(option)
+    if optInfo == None:
+        raise CommandError("driver %s has no option %s" %
+                           (driverName, option))
+    if not optInfo.validate(value):
+        raise CommandError("invalid value %s for option %s" %
+                           (value, option))
+
+
+def cmdSet(args):
+    """ Set an option value in a device and application section. """
+    if not args.force:
+        checkValue(args.driver, args.option, args.value)
+    config = readConfig(args.file or userConfigFile(), mustExist=False)
+    device = findDevice(config, args.screen, args.driver, create=True)
+    app = findApp(device, args.executable, args.name, create=True)
+    app.options[args.option] = args.value
+    writeConfig(config)
+
+
+def cmdUnset(args):
+    """ Remove an option setting from a device and application
+    section. """
+    config = readConfig(args.file or userConfigFile())
+    device = findDevice(config, args.screen, args.driver)
+    app = device and findApp(device, args.executable)
+    if app == None or not app.options.has_key(args.option):
+        raise CommandError("option %s is not set" % args.option)
+    del app.options[args.option]
+    writeConfig(config)
+
+
+def cmdValidate(args):
+    """ Check all option settings against the drivers. Returns the
+    number of problems. """
+    problems = 0
+    for config in readConfigList(args.files):
+        for device in config.devices:
+            if device.driver == None:
+                continue
+            try:
+                driver = dri.GetDriver(device.driver, 0)
+            except (dri.DRIError, dri.XMLError), problem:
+                print "%s: driver %s: %s" % (config.fileName, device.driver,
+                                             problem)
+                problems = problems + 1
+                continue
+            for app in device.apps:
+                for name, value in app.options.items():
+                    optInfo = driver.getOptInfo(name)
+                    if optInfo == None:
+                        message = "unknown option %s" % name
+                    elif not optInfo.validate(value):
+                        message = "invalid value %s for option %s" % \
+                                  (value, name)
+                    else:
+                        continue
+                    print "%s: driver %s, application %s: %s" % \
+                          (config.fileName, device.driver, app.name, message)
+                    problems = problems + 1
+    return problems
+
+
+def cmdNormalize(args):
+    """ Normalize the user configuration file like the simple UI
+    does. """
+    configList = readConfigList(args.files)
+    userConfig = dri.GetUserConfig(configList)
+    if userConfig == None:
+        raise CommandError("no user configuration file")
+    dpyInfo = getDisplayInfo(args.display)
+    if dri.NormalizeConfig(configList, dpyInfo) == None:
+        raise CommandError("normalization of %s failed" %
+                           userConfig.fileName)
+    if getattr(userConfig, "isModified", False):
+        writeConfig(userConfig)
+
+
+def formatResolved(results):
+    """ Format results of dri.ResolveExecutables as JSON lines. """
+    return "".join([json.dumps({"screen": screen, "driver": driver,
+                                "executable": executable,
+                                "options": values}) + "\n"
+                    for screen, driver, executable, values in results])
+
+
+def resolveChunk(task):
+    """ Resolve a chunk of executables on one target in a worker
+    process. """
+    target, executables = task
+    return formatResolved(dri.ResolveExecutables(
+        _resolver, [_targets[target]], executables))
+
+
+def readExecutables(args):
+    executables = list(args.executables)
+    if args.input:
+        if args.input == "-":
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(args.input, "r")
+            except IOError, problem:
+                raise CommandError("cannot read %s: %s" %
+                                   (args.input, problem.strerror))
+        for line in lines:
+            line = line.strip()
+            if line:
+                executables.append(line)
+    return executables
+
+
+def getTargets(args):
+    """ (screen, driver, driverInfo) tuples to resolve for.
+
+    Without --driver the display is probed and --screen selects one of
+    its screens. """
+    if args.driver != None:
+        try:
+            driver = dri.GetDriver(args.driver, 0)
+        except (dri.DRIError, dri.XMLError), problem:
+            raise CommandError("driver %s: %s" % (args.driver, problem))
+        return [(args.screen, args.driver, driver)]
+    dpyInfo = getDisplayInfo(args.display)
+    targets = [(screen.num, screen.driver.name, screen.driver)
+               for screen in dpyInfo.screens if screen != None and
+               (args.screen == None or screen.num == args.screen)]
+    if args.screen != None and not targets:
+        raise CommandError("screen %d is not a configurable direct "
+                           "rendering screen" % args.screen)
+    return targets
+
+
+def cmdResolve(args):
+    """ Print the option values executables get as JSON lines. """
+    global _resolver, _targets
+    _resolver = dri.ConfigResolver(readConfigList(args.files))
+    _targets = getTargets(args)
+    executables = readExecutables(args)
+    if args.all:
+        executables.insert(0, None)
+    tasks = [(target, executables[i:i + args.chunk_size])
+             for target in range(len(_targets))
+             for i in range(0, len(executables), args.chunk_size)]
+    if args.jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(resolveChunk, tasks)
+    else:
+        pool = None
+        results = itertools.imap(resolveChunk, tasks)
+    for lines in results:
+        sys.stdout.write(lines)
+    if pool != None:
+        pool.close()
+        pool.join()
+
+
+def cmdExplain(args):
+    """ Print where the option values of an executable come from. """
+    resolver = dri.ConfigResolver(readConfigList(args.files, True), True)
+    for screen, driver, driverInfo in getTargets(args):
+        print "screen %s, driver %s, executable %s:" % \
+              (screen, driver, args.executable)
+        explained = resolver.explain(screen, driver, args.executable,
+                                     driverInfo)
+        names = args.options or sorted(explained.keys())
+        for name in names:
+            if not explained.has_key(name):
+                print "    %s: not set" % name
+                continue
+            value, origin = explained[name]
+            if origin == None:
+                print "    %s = %s (driver default)" % (name, value)
+                continue
+            fileName, device, app, line = origin
+            print "    %s = %s (%s:%s, device %d, application %d)" % \
+                  (name, value, fileName, line, device, app)
+
+
+def addSectionArguments(parser):
+    parser.add_argument("-f", "--file",
+                        help="Configuration file (default: ~/.drirc)")
+    parser.add_argument("-s", "--screen",
+                        help="Screen of the device section")
+    parser.add_argument("-d", "--driver",
+                        help="Driver of the device section")
+    parser.add_argument("-x", "--executable",
+                        help="Executable of the application section "
+                        "(default: all applications)")
+    parser.add_argument("option", help="Option name")
+
+
+def main(argv=None):
+    """ Run a command. Returns the exit status. """
+    if argv == None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        prog="driconf", description="Query and edit DRI configuration "
+        "files without the graphical user interface.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    sub = subparsers.add_parser("list", help="List screens and drivers")
+    sub.add_argument("-o", "--options", action="store_true",
+                     help="List driver options, too")
+    sub.add_argument("--display", help="X display to probe")
+    sub.set_defaults(func=cmdList)
+
+    sub = subparsers.add_parser("get", help="Print an option value")
+    addSectionArguments(sub)
+    sub.set_defaults(func=cmdGet)
+
+    sub = subparsers.add_parser("set", help="Set an option value")
+    addSectionArguments(sub)
+    sub.add_argument("value", help="Option value")
+    sub.add_argument("-n", "--name",
+                     help="Name of a new application section")
+    sub.add_argument("--force", action="store_true",
+                     help="Don't validate the value against the driver")
+    sub.set_defaults(func=cmdSet)
+
+    sub = subparsers.add_parser("unset", help="Remove an option setting")
+    addSectionArguments(sub)
+    sub.set_defaults(func=cmdUnset)
+
+    sub = subparsers.add_parser("validate",
+                                help="Check option settings against the "
+                                "drivers")
+    sub.add_argument("files", nargs="*", metavar="file",
+                     help="Configuration files (default: /etc/drirc and "
+                     "~/.drirc)")
+    sub.set_defaults(func=cmdValidate)
+
+    sub = subparsers.add_parser("normalize",
+                                help="Normalize the user configuration "
+                                "file like the simple user interface")
+    sub.add_argument("files", nargs="*", metavar="file",
+                     help="Configuration files (default: /etc/drirc and "
+                     "~/.drirc)")
+    sub.add_argument("--display", help="X display to probe")
+    sub.set_defaults(func=cmdNormalize)
+
+    sub = subparsers.add_parser("resolve",
+                                help="Print the option values "
+                                "executables get, as JSON lines")
+    sub.add_argument("executables", nargs="*", metavar="executable",
+                     help="Executables to resolve")
+    sub.add_argument("-i", "--input", metavar="FILE",
+                     help="Read executables from FILE, one per line "
+                     "(- for standard input)")
+    sub.add_argument("-a", "--all", action="store_true",
+                     help="Also resolve the values for applications "
+                     "without specific settings")
+    sub.add_argument("-c", "--config", action="append", dest="files",
+                     metavar="FILE", help="Configuration file, may be "
+                     "repeated (default: /etc/drirc and ~/.drirc)")
+    sub.add_argument("-s", "--screen", type=int,
+                     help="Screen (default: all screens of the display, "
+                     "none with --driver)")
+    sub.add_argument("-d", "--driver",
+                     help="Driver, resolve for this driver instead of "
+                     "probing the display")
+    sub.add_argument("-j", "--jobs", type=int, default=1,
+                     help="Number of worker processes (default: 1)")
+    sub.add_argument("--chunk-size", type=int, default=1000,
+                     help="Executables per worker task (default: 1000)")
+    sub.add_argument("--display", help="X display to probe")
+    sub.set_defaults(func=cmdResolve)
+
+    sub = subparsers.add_parser("explain",
+                                help="Print where the option values of "
+                                "an executable come from")
+    sub.add_argument("executable", nargs="?",
+                     help="Executable (default: applications without "
+                     "specific settings)")
+    sub.add_argument("-o", "--option", action="append", dest="options",
+                     metavar="OPTION", help="Option to explain, may be "
+                     "repeated (default: all)")
+    sub.add_argument("-c", "--config", action="append", dest="files",
+                     metavar="FILE", help="Configuration file, may be "
+                     "repeated (default: /etc/drirc and ~/.drirc)")
+    sub.add_argument("-s", "--screen", type=int,
+                     help="Screen (default: all screens of the display, "
+                     "none with --driver)")
+    sub.add_argument("-d", "--driver",
+                     help="Driver, explain for this driver instead of "
+                     "probing the display")
+    sub.add_argument("--display", help="X display to probe")
+    sub.set_defaults(func=cmdExplain)
+
+    args = parser.parse_args(argv)
+    try:
+        if args.func(args):
+            return 1
+    except CommandError, problem:
+        sys.stderr.write("driconf: %s\n" % problem)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,31 +28,53 @@ pygtk.require("2.0")
 import gtk
 import gobject
 
-# Install translations. Search in the current directory first (for
-# easy testing). Then search in the default location and in
-# /usr/local/share/locale. If all this fails fall back to the null
-# translation.
-try:
-    _ = gettext.translation("driconf", ".").ugettext
-except IOError:
-    try:
-        _ = gettext.translation("driconf").ugettext
-    except IOError:
-        _ = gettext.translation("driconf",
-                                "/usr/local/share/locale",
-                                fallback=True).ugettext
-
-# global variable: lang
-locale.setlocale(locale.LC_ALL, '')
-lang, encoding = locale.getlocale(locale.LC_MESSAGES)
-if lang:
-    underscore = lang.find('_')
-    if underscore != -1:
-        lang = lang[0:underscore]
-else:
-    lang = "en"
-# encoding is only a dummy. Pango uses UTF-8 everywhere. :)
-del encoding
+# The locale and translations are set up on first use, so that importing
+# this module has no side effects.
+_ugettext = None
+_lang = None
+
+
+def _initLocale():
+    global _lang
+    locale.setlocale(locale.LC_ALL, '')
+    lang, encoding = locale.getlocale(locale.LC_MESSAGES)
+    # encoding is only a dummy. Pango uses UTF-8 everywhere. :)
+    if lang:
+        underscore = lang.find('_')
+        if underscore != -1:
+            lang = lang[0:underscore]
+    else:
+        lang = "en"
+    _lang = lang
+
+
+def _(message):
+    """ Translate message. """
+    global _ugettext
+    if _ugettext == None:
+        if _lang == None:
+            _initLocale()
+        # Install translations. Search in the current directory first
+        # (for easy testing). Then search in the default location and in
+        # /usr/local/share/locale. If all this fails fall back to the
+        # null translation.
+        try:
+            _ugettext = gettext.translation("driconf", ".").ugettext
+        except IOError:
+            try:
+                _ugettext = gettext.translation("driconf").ugettext
+            except IOError:
+                _ugettext = gettext.translation(
+                    "driconf", "/usr/local/share/locale",
+                    fallback=True).ugettext
+    return _ugettext(message)
+
+
+def getLang():
+    """ The language of the user's locale, e.g. "de". """
+    if _lang == None:
+        _initLocale()
+    return _lang
 
 # global variable: version
 version = "0.9.1"
@@ -322,7 +344,7 @@ class OptionLine:
             typeString = typeString+" ["+ \
                          reduce(lambda x,y: x+','+y, map(str,opt.valid))+"]"
         # a check button with an option description
-        desc = opt.getDesc([lang])
+        desc = opt.getDesc([getLang()])
         if desc != None:
             desc = desc.text
         else:
@@ -411,7 +433,7 @@ class OptionLine:
         elif type == "enum" or \
              (type != "invalid" and opt.valid and
               reduce (lambda x,y: x and y, map(dri.Range.empty, opt.valid))):
-            desc = opt.getDesc([lang])
+            desc = opt.getDesc([getLang()])
             optValList = []
             for r in opt.valid:
                 if type == "enum":
@@ -524,7 +546,7 @@ class OptionLine:
         value = self.getValue()
         if value == None:
             return
-        valid = self.opt.validate(value)
+        valid = self.opt.validateCached(value)
         if (valid and not self.isValid) or (not valid and self.isValid):
             self.isValid = valid
             self.highlightInvalid()
@@ -618,11 +640,10 @@ class UnknownSectionPage(gtk.VBox):
         # remove all options known to the driver
         self.driverOpts = {}
         if driver:
-            for sect in driver.optSections:
-                for opt in sect.optList:
-                    self.driverOpts[opt.name] = opt
-                    if opts.has_key(opt.name):
-                        del opts[opt.name]
+            self.driverOpts = driver.optIndex
+            for name in opts.keys():
+                if self.driverOpts.has_key(name):
+                    del opts[name]
         # short cut
         self.opts = []
         if driver and len(opts) == 0:
@@ -27,7 +27,7 @@ import gobject
 import driconf_commonui
 commonui = driconf_commonui  # short cut
 
-from driconf_commonui import _, lang, findInShared, escapeMarkup, WrappingCheckButton, SectionPage, UnknownSectionPage
+from driconf_commonui import _, getLang, findInShared, escapeMarkup, WrappingCheckButton, SectionPage, UnknownSectionPage
 
 
 class DriverPanel(gtk.Frame):
@@ -83,7 +83,7 @@ class DriverPanel(gtk.Frame):
             for sect in driver.optSections:
                 sectPage = SectionPage(sect, app, False)
                 sectPage.show()
-                desc = sect.getDesc([lang])
+                desc = sect.getDesc([getLang()])
                 if desc:
                     sectLabel = gtk.Label(desc)
                     sectLabel.set_line_wrap(True)
@@ -470,17 +470,19 @@ class ConfigTreeModel(gtk.GenericTreeModel):
     def addNode(self, node, sibling=None):
         """ Add a new node and inform the TreeView. """
         self.initNode(node)
-        if node.__class__ == dri.DRIConfig:
-            list = self.configList
-        elif node.__class__ == dri.DeviceConfig:
-            list = node.config.devices
-        elif node.__class__ == dri.AppConfig:
-            list = node.device.apps
-        if sibling != None:
-            index = list.index(sibling)
-            list.insert(index, node)
+        if node.__class__ == dri.AppConfig:
+            # Keeps the device's application indexes up to date
+            node.device.addApp(node, sibling)
         else:
-            list.append(node)
+            if node.__class__ == dri.DRIConfig:
+                list = self.configList
+            else:
+                list = node.config.devices
+            if sibling != None:
+                index = list.index(sibling)
+                list.insert(index, node)
+            else:
+                list.append(node)
         self.registerNode(node)
 
     def initNode(self, node):
@@ -516,10 +518,11 @@ class ConfigTreeModel(gtk.GenericTreeModel):
             list = node.config.devices
             while len(node.apps) > 0:
                 self.removeNode(node.apps[0])
-        elif node.__class__ == dri.AppConfig:
-            list = node.device.apps
         path = self.on_get_path(node)
-        list.remove(node)
+        if node.__class__ == dri.AppConfig:
+            node.device.removeApp(node)
+        else:
+            list.remove(node)
         self.row_deleted(path)
 
     # find the first writable application
@@ -725,7 +728,7 @@ class ConfigTreeView(gtk.TreeView):
             dialog.destroy()
             return
         commonui.mainWindow.commitDriverPanel()
-        file.write(str(config))
+        config.write(file)
         file.close()
         config.modified(config, False)
 
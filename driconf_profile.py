@@ -0,0 +1,141 @@
+# DRI configuration GUI: startup profiling
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import time
+import json
+
+
+class NullProfiler:
+    """ Does nothing. Used when profiling is disabled. """
+
+    def begin(self, name):
+        pass
+
+    def end(self, name):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+
+class Profiler:
+    """ Records the timing of nested startup phases and some counters. """
+
+    def __init__(self):
+        self.start = time.time()
+        # (name, start, duration) of finished phases in order of their end
+        self.phases = []
+        self.running = {}
+        self.counters = {}
+        self.counterOrder = []
+
+    def begin(self, name):
+        """ Start a phase. """
+        self.running[name] = time.time()
+
+    def end(self, name):
+        """ End a phase. Phases that were not started are ignored. """
+        if not self.running.has_key(name):
+            return
+        start = self.running.pop(name)
+        self.phases.append((name, start, time.time() - start))
+
+    def count(self, name, n=1):
+        """ Add n to a counter. """
+        self.set(name, self.counters.get(name, 0) + n)
+
+    def set(self, name, value):
+        """ Set a counter. """
+        if not self.counters.has_key(name):
+            self.counterOrder.append(name)
+        self.counters[name] = value
+
+    def printSummary(self):
+        print "Startup profile:"
+        phases = self.phases[:]
+        phases.sort(lambda a, b: cmp(a[1], b[1]))
+        for name, start, duration in phases:
+            print "  %-32s %10.1f ms (at %.1f ms)" % \
+                  (name, duration * 1000.0, (start - self.start) * 1000.0)
+        for name in self.counterOrder:
+            value = self.counters[name]
+            if isinstance(value, float):
+                print "  %-32s %10.1f" % (name, value)
+            else:
+                print "  %-32s %10d" % (name, value)
+
+    def writeTrace(self, fileName):
+        """ Write the phases as Chrome trace events to fileName.
+
+        The file can be loaded in chrome://tracing or similar trace
+        viewers. """
+        pid = os.getpid()
+        events = []
+        for name, start, duration in self.phases:
+            events.append({"name": name, "cat": "startup", "ph": "X",
+                           "ts": int((start - self.start) * 1e6),
+                           "dur": int(duration * 1e6),
+                           "pid": pid, "tid": 1})
+        end = int((time.time() - self.start) * 1e6)
+        for name in self.counterOrder:
+            events.append({"name": name, "cat": "startup", "ph": "C",
+                           "ts": end, "pid": pid, "tid": 1,
+                           "args": {name: self.counters[name]}})
+        out = open(fileName, "w")
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
+        out.close()
+
+
+# The active profiler. main replaces it with a Profiler if profiling is
+# enabled.
+profiler = NullProfiler()
+
+
+def enable():
+    """ Enable profiling and return the Profiler. """
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def countObjects(configList, dpy):
+    """ Record the number of configuration and driver objects. """
+    devices = 0
+    apps = 0
+    options = 0
+    for config in configList:
+        devices = devices + len(config.devices)
+        for device in config.devices:
+            apps = apps + len(device.apps)
+            for app in device.apps:
+                options = options + len(app.options)
+    profiler.set("device sections", devices)
+    profiler.set("application sections", apps)
+    profiler.set("option settings", options)
+    if dpy != None:
+        drivers = {}
+        for screen in dpy.screens:
+            if screen != None:
+                drivers[screen.driver.name] = screen.driver
+        profiler.set("screens", len(dpy.screens))
+        profiler.set("drivers", len(drivers))
+        profiler.set("driver options", sum([len(driver.optIndex)
+                                            for driver in drivers.values()]))
+        profiler.set("glxinfo runs avoided", dpy.glxInfoAvoided())
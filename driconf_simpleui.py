@@ -26,243 +26,27 @@ import gtk
 import gobject
 
 import driconf_commonui
-import driconf_complexui
+import driconf_profile
 commonui = driconf_commonui  # short cut
-complexui = driconf_complexui
 
-from driconf_commonui import _, lang
+from driconf_commonui import _, getLang
 
 
-def isUserConfig(config):
-    return config.fileName.startswith(os.environ["HOME"])
+# The normalization functions moved to dri, so that they can be used
+# without GTK.
+isUserConfig = dri.IsUserConfig
+getUserConfig = dri.GetUserConfig
+genNormalDeviceConfigs = dri.GenNormalDeviceConfigs
+removeRedundantDevices = dri.RemoveRedundantDevices
+isRedundant = dri.IsRedundant
+isNormalized = dri.IsNormalized
+normalizeConfig = dri.NormalizeConfig
 
 
-def getUserConfig(configList):
-    userConfigs = [config for config in configList if isUserConfig(config)]
-    if not userConfigs:
-        return None
-    else:
-        return userConfigs[0]
-
-
-def genNormalDeviceConfigs(configList, dpy):
-    """ Generate a list of normalized device configurations.
-
-    One device configuration for each installed device. Each contains
-    a default application configuration that explicitly sets all
-    options to their default values in order to override values in
-    previous less specific device sections. Then it appends
-    application configurations for all application configurations in
-    all configuration files that affect the respective device. The
-    result is one device configuration per existing device that
-    summarizes the entire configuration of existing devices and
-    overrides any previous settings.
-
-    If there is no user configuration file, an empty list is returned. """
-    userConfig = getUserConfig(configList)
-    if not userConfig:
-        return []
-    screens = [screen for screen in dpy.screens if screen]
-    deviceConfigs = []
-    # Create one device configuration for each installed device on this display
-    for screen in screens:
-        if screen == None:
-            continue
-        driver = screen.driver
-        deviceConfig = dri.DeviceConfig(userConfig, str(screen.num),
-                                        driver.name)
-        defaultApp = dri.AppConfig(deviceConfig, "Default")
-        deviceConfig.apps.append(defaultApp)
-        for sect in driver.optSections:
-            for opt in sect.options.values():
-                defaultApp.options[opt.name] = dri.ValueToStr(opt.default,
-                                                              opt.type)
-        deviceConfig.isNormalized = True
-        deviceConfigs.append(deviceConfig)
-    for config in configList:
-        configIsUser = isUserConfig(config)
-        for device in config.devices:
-            # Determine all installed devices affected by this device-section
-            # in the original configuration file
-            curDeviceConfigs = [
-                deviceConfig
-                for deviceConfig in deviceConfigs
-                if (device.screen == None or device.screen ==
-                    deviceConfig.screen) and
-                (device.driver == None or device.driver == deviceConfig.driver)
-            ]
-            for curDevice in curDeviceConfigs:
-                driver = dpy.getScreen(int(curDevice.screen)).driver
-                for app in device.apps:
-                    # Determine all applications on this device affected by
-                    # this application section in the original config file.
-                    # It should be one at most. Create a new application
-                    # configuration if needed.
-                    curApps = [curApp
-                               for curApp in curDevice.apps
-                               if app.executable == curApp.executable]
-                    assert len(curApps) <= 1
-                    if curApps:
-                        curApp = curApps[0]
-                    else:
-                        curApp = dri.AppConfig(curDevice, app.name,
-                                               app.executable)
-                        curDevice.apps.append(curApp)
-                    # Update all option settings. Non-existing options
-                    # or invalid values are only considered in
-                    # redundant device sections.
-                    for opt, value in app.options.items():
-                        isValid = False
-                        if configIsUser and \
-                               device.screen != None and device.driver != None:
-                            isValid = True
-                        else:
-                            optInfo = driver.getOptInfo(opt)
-                            if optInfo and optInfo.validate(value):
-                                isValid = True
-                        if isValid:
-                            curApp.options[opt] = value
-    return deviceConfigs
-
-
-def removeRedundantDevices(config, normalDeviceConfigs, onlyTest=False):
-    """ Remove device configurations that are redundant ...
-
-    ... after appending normalized device configurations. If onlyTest
-    is True, the configuration file is not modified and this function
-    returns True iff there are redundant device sections. Otherwise
-    False is returned. """
-    screens = [device.screen for device in normalDeviceConfigs]
-    # Iterate over a copy of the device list, so that devices can be
-    # removed safely.
-    for device in config.devices[:]:
-        if not (hasattr(device, "isNormalized") and device.isNormalized) and \
-               device.screen != None and device.driver != None:
-            # See if there is a normalized device configuration for
-            # this device. In that case this section is redundant.
-            try:
-                i = screens.index(device.screen)
-            except ValueError:
-                pass
-            else:
-                if normalDeviceConfigs[i].driver == device.driver:
-                    if onlyTest:
-                        return True
-                    # Remove redundant device section
-                    config.devices.remove(device)
-                    config.isModified = True
-    return False
-
-
-def isRedundant(configList, dpy, normalDeviceConfigs=None):
-    """ Check if the user configuration is redundant.
-
-    Returns True iff there is a user configuration file that would
-    contain redundant device configurations after appending
-    normalDeviceConfigs. """
-    userConfig = getUserConfig(configList)
-    if not userConfig:
-        return False
-    if normalDeviceConfigs == None:
-        normalDeviceConfigs = genNormalDeviceConfigs(configList, dpy)
-    return removeRedundantDevices(userConfigs,
-                                  normalDeviceConfigs,
-                                  onlyTest=True)
-
-
-def isNormalized(configList, dpy, normalDeviceConfigs=None):
-    """ Check if the user configuration file is normalized ...
-
-    ... in a set of configuration files, that is if the user
-    configuration file would be the same (except for names) after
-    normalization. If the user configuration file is normalized, a
-    list of existing normalized device configurations is returned. If
-    there is no user configuration file, an empty list is
-    returned. Otherwise, if there is a user configuration file that is
-    not normalized, this function returns None."""
-    userConfig = getUserConfig(configList)
-    if not userConfig:
-        return []
-    userDevs = userConfig.devices
-    # Find a consistent list of specific device configurations at the
-    # end of the user configuration file.
-    i = len(userDevs) - 1
-    while i >= 0 and userDevs[i].screen != None and userDevs[i].driver != None:
-        i = i - 1
-    i = i + 1
-    specificDevs = userDevs[i:]
-    # Make sure there is at least one for each configurable screen.
-    # If there are several the last one counts.
-    screens = [screen for screen in dpy.screens if screen]
-    screenDevs = [None for i in range(len(screens))]
-    for device in specificDevs:
-        screenNum = int(device.screen)
-        if screenNum >= len(screenDevs):
-            continue
-        if screens[screenNum].driver.name == device.driver:
-            screenDevs[screenNum] = device
-    if [None for device in screenDevs if device == None]:
-        return None  # There are unconfigured screens
-    if normalDeviceConfigs == None:
-        normalDeviceConfigs = genNormalDeviceConfigs(configList, dpy)
-    # Compare existing normalized device configs with generated
-    # ones. If they are equivalent, the configuration file is
-    # normalized.
-    for device, normalDev in zip(screenDevs, normalDeviceConfigs):
-        # Check that the first executable is None and that each
-        # executable is configured exactly once.
-        executables = [app.executable for app in device.apps]
-        if not executables or executables[0] != None:
-            return None
-        del executables[0]
-        if [None for exe in executables if exe == None]:
-            return None
-        executables.sort()
-        normalExes = [app.executable for app in normalDev.apps]
-        del normalExes[0]
-        normalExes.sort()
-        if normalExes != executables:
-            return None
-        # Now check that each application contains the same option settings
-        # as the generated normalized configuration
-        for normalApp in normalDev.apps:
-            app = [dApp
-                   for dApp in device.apps
-                   if dApp.executable == normalApp.executable][0]
-            if app.options != normalApp.options:
-                return None
-    # The configuration is normalized. Return the list of normalized device
-    # configurations from the user configuration files.
-    return screenDevs
-
-
-def normalizeConfig(configList, dpy):
-    """ Normalize the user configuration file (if it exists) ...
-
-    ... by appending normalized device configurations for each
-    installed device and removing redundant device configurations. If
-    the user configuration file is already normalized, only existing
-    normalized device configurations are marked as such and redundant
-    device configurations are removed. """
-    newDeviceConfigs = genNormalDeviceConfigs(configList, dpy)
-    existingDeviceConfigs = isNormalized(configList, dpy, newDeviceConfigs)
-    if not existingDeviceConfigs and not newDeviceConfigs:
-        return []
-    userConfig = getUserConfig(configList)
-    if existingDeviceConfigs:
-        # is already normalized, mark existing normalized device
-        # configurations as such.
-        for deviceConfig in existingDeviceConfigs:
-            deviceConfig.isNormalized = True
-        deviceConfigs = existingDeviceConfigs
-    elif newDeviceConfigs:
-        userConfig.devices.extend(newDeviceConfigs)
-        userConfig.isModified = True
-        deviceConfigs = newDeviceConfigs
-    # Remove redundant device configurations from the user
-    # configuration file
-    removeRedundantDevices(userConfig, deviceConfigs)
-    return deviceConfigs
+def startExpertMode(configList):
+    """ Start the complex UI. It is only imported when needed. """
+    import driconf_complexui
+    driconf_complexui.start(configList)
 
 
 def lineWrap(string, chars=30):
@@ -376,7 +160,7 @@ class AppPage(gtk.ScrolledWindow):
         sectI = 0
         for sect in self.driver.optSections:
             sectIter = self.optionTree.append(None, [
-                lineWrap(sect.getDesc([lang])), sectI, -1
+                lineWrap(sect.getDesc([getLang()])), sectI, -1
             ])
             sectHasOpts = False
             optI = 0
@@ -387,7 +171,7 @@ class AppPage(gtk.ScrolledWindow):
                     i = i + 1
                 else:
                     self.optionTree.append(sectIter, [
-                        lineWrap(opt.getDesc([lang]).text), sectI, optI
+                        lineWrap(opt.getDesc([getLang()]).text), sectI, optI
                     ])
                     sectHasOpts = True
                 optI = optI + 1
@@ -457,6 +241,8 @@ class MainWindow(gtk.Window):
         self.configList = configList  # Remember for switching to expert mode
         self.userConfig = getUserConfig(configList)
         self.screens = [screen for screen in commonui.dpy.screens if screen]
+        # The device labels show the glxinfo strings of all screens
+        commonui.dpy.probeGLXInfo()
         self.vbox = gtk.VBox(spacing=10)
         if len(self.screens) > 1:
             self.deviceCombo = gtk.combo_box_new_text()
@@ -590,7 +376,7 @@ class MainWindow(gtk.Window):
                                             True)
             sectPage.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
             sectPage.show()
-            desc = sect.getDesc([lang])
+            desc = sect.getDesc([getLang()])
             if desc:
                 sectLabel = gtk.Label(desc)
                 sectLabel.set_line_wrap(True)
@@ -734,19 +520,19 @@ class MainWindow(gtk.Window):
             errorStr = _("You must enter both an application name and "
                          "an executable name.")
         else:
-            for app in self.deviceConfig.apps:
-                if app != sameApp and name == app.name:
-                    errorStr = _("There exists an application "
-                                 "configuration with the same name. "
-                                 "Please enter a different name.")
-                    break
-                elif app != sameApp and executable == app.executable:
-                    errorStr = _("There exists an application "
-                                 "configuration for the same "
-                                 "executable. You can't create multiple "
-                                 "application configurations for the "
-                                 "same executable.")
-                    break
+            device = self.deviceConfig
+            if [app for app in device.appsByName.get(name, ())
+                if app != sameApp]:
+                errorStr = _("There exists an application "
+                             "configuration with the same name. "
+                             "Please enter a different name.")
+            elif [app for app in device.appsByExecutable.get(executable, ())
+                  if app != sameApp]:
+                errorStr = _("There exists an application "
+                             "configuration for the same "
+                             "executable. You can't create multiple "
+                             "application configurations for the "
+                             "same executable.")
         if errorStr:
             dialog = gtk.MessageDialog(
                 dialog, gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
@@ -766,7 +552,7 @@ class MainWindow(gtk.Window):
                 executable = dialog.getExecutable().strip()
                 if self.checkAppProperties(dialog, name, executable):
                     app = dri.AppConfig(self.deviceConfig, name, executable)
-                    self.deviceConfig.apps.append(app)
+                    self.deviceConfig.addApp(app)
                     self.appCombo.append_text(name)
                     self.appCombo.set_active(len(self.deviceConfig.apps) - 2)
                     self.configModified(self.deviceConfig)
@@ -812,7 +598,7 @@ class MainWindow(gtk.Window):
         else:
             newI = 0
             newApp = None
-        del self.deviceConfig.apps[i]
+        self.deviceConfig.removeApp(self.appPage.app)
         self.selectApp(newApp)
         self.appCombo.remove_text(i - 1)
         self.appCombo.set_active(newI - 1)
@@ -830,7 +616,7 @@ class MainWindow(gtk.Window):
 
     def expertHandler(self, widget):
         self.destroy()  # triggers main_quit
-        complexui.start(self.configList)
+        startExpertMode(self.configList)
         gtk.main()
 
     def configModified(self, node, b=True):
@@ -849,7 +635,7 @@ class MainWindow(gtk.Window):
             self.inConfigModified = False
             return
         self.commit()
-        file.write(str(self.userConfig))
+        self.userConfig.write(file)
         file.close()
 
     def validateDriverPanel(self):
@@ -866,7 +652,7 @@ def start(configList):
             _("DRIconf will be started in expert mode."))
         dialog.run()
         dialog.destroy()
-        complexui.start(configList)
+        startExpertMode(configList)
         return
     if not userConfig.writable:
         # Not writable: start expert mode
@@ -877,9 +663,11 @@ def start(configList):
             _("DRIconf will be started in expert mode."))
         dialog.run()
         dialog.destroy()
-        complexui.start(configList)
+        startExpertMode(configList)
         return
+    driconf_profile.profiler.begin("normalize")
     normalizedDeviceConfigs = normalizeConfig(configList, commonui.dpy)
+    driconf_profile.profiler.end("normalize")
     if normalizedDeviceConfigs == None:
         dialog = gtk.MessageDialog(
             None, 0, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK,
@@ -891,7 +679,7 @@ def start(configList):
         dialog.run()
         dialog.destroy()
         userConfig.writable = False
-        complexui.start(configList)
+        startExpertMode(configList)
         return
     mainWindow = MainWindow(configList)
     commonui.mainWindow = mainWindow
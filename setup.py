@@ -13,7 +13,7 @@ setup(name="driconf",
       author_email="fxkuehl@gmx.de",
       url="http://dri.freedesktop.org/wiki/DriConf",
       py_modules=["dri", "driconf", "driconf_commonui", "driconf_complexui",
-                  "driconf_simpleui"],
+                  "driconf_simpleui", "driconf_profile", "driconf_cli"],
       scripts=["driconf"],
       data_files=[("share/driconf",
                    ["card.png", "screen.png", "screencard.png", "drilogo.jpg",